@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+from __future__ import print_function
+from optparse import OptionParser
+import gc
+import gzip
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import dna_io_v2 as dna_io
+import seq_hdf5_v2
+
+################################################################################
+# bench_v2.py
+#
+# Benchmark the stages of the encoding pipeline on synthetic data: a gzipped
+# FASTA with the given record count, length distribution and heterozygous
+# site density, plus a matching melted scores file. Each stage is timed over
+# --repeat runs, keeping the best, and run once more under tracemalloc for
+# its peak memory. Results are written as JSON to compare versions.
+################################################################################
+
+het_nts = 'MRWSYK'
+
+stage_names = ['hash_sequences_1hot', 'dna_one_hot', 'hash_scores', 'align_seqs_scores_1hot', 'vecs2dna', 'hdf5_write', 'hdf5_stream']
+
+################################################################################
+# main
+################################################################################
+def main():
+    usage = 'usage: %prog [options] <out_json>'
+    parser = OptionParser(usage)
+    parser.add_option('-n', dest='num_seqs', default=10000, type='int', help='Number of records [Default: %default]')
+    parser.add_option('-l', dest='len_mean', default=1000, type='int', help='Mean record length [Default: %default]')
+    parser.add_option('--len_sd', dest='len_sd', default=0, type='float', help='Standard deviation of normally distributed record lengths, 0 for a fixed length [Default: %default]')
+    parser.add_option('--het', dest='het_density', default=0.001, type='float', help='Fraction of positions with a heterozygous IUPAC code [Default: %default]')
+    parser.add_option('--labels', dest='num_labels', default=1, type='int', help='Score lines (labels) per record in the melted scores file [Default: %default]')
+    parser.add_option('-e', dest='extend_length', default=None, type='int', help='Extend all sequences to this length [Default: %default]')
+    parser.add_option('-r', dest='repeat', default=1, type='int', help='Timed runs per stage, keeping the fastest [Default: %default]')
+    parser.add_option('-s', dest='random_seed', default=1, type='int', help='Seed of the synthetic data [Default: %default]')
+    parser.add_option('--stages', dest='stages', default=','.join(stage_names), help='Comma-separated stages to run [Default: %default]')
+    parser.add_option('--data_dir', dest='data_dir', default=None, help='Write the synthetic files here and keep them, instead of a temporary directory [Default: %default]')
+    (options,args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error('Must provide output JSON file')
+    else:
+        out_json = args[0]
+
+    stages = options.stages.split(',')
+    for stage in stages:
+        if stage not in stage_names:
+            parser.error('Unknown stage %s, choose from %s' % (stage, ', '.join(stage_names)))
+
+    if options.data_dir is None:
+        data_dir = tempfile.mkdtemp(prefix='bench_v2.')
+    else:
+        data_dir = options.data_dir
+        if not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+
+    try:
+        fasta_file = os.path.join(data_dir, 'seqs.fa.gz')
+        scores_file = os.path.join(data_dir, 'scores.txt.gz')
+        h5_file = os.path.join(data_dir, 'seqs.h5')
+
+        print('Generate data', file=sys.stderr)
+        rng = np.random.RandomState(options.random_seed)
+        headers, num_bases = synthetic_fasta(fasta_file, options.num_seqs, options.len_mean, options.len_sd, options.het_density, rng)
+        synthetic_scores(scores_file, headers, options.num_labels, rng)
+
+        results = bench_stages(stages, fasta_file, scores_file, h5_file, options)
+        for result in results:
+            result['bases_per_s'] = num_bases / result['seconds'] if result['seconds'] > 0 else None
+            print('%-24s %8.3f s %10.1f MB peak' % (result['stage'], result['seconds'], result['peak_mb']), file=sys.stderr)
+    finally:
+        if options.data_dir is None:
+            shutil.rmtree(data_dir)
+
+    report = {
+        'params': {
+            'num_seqs': options.num_seqs,
+            'len_mean': options.len_mean,
+            'len_sd': options.len_sd,
+            'het_density': options.het_density,
+            'num_labels': options.num_labels,
+            'extend_length': options.extend_length,
+            'repeat': options.repeat,
+            'random_seed': options.random_seed,
+            'num_bases': num_bases
+        },
+        'version': git_version(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'stages': results
+    }
+
+    with open(out_json, 'w') as json_out:
+        json.dump(report, json_out, indent=2)
+
+
+################################################################################
+# bench_stages
+#
+# Run the stages in order, each stage reading the outputs of earlier ones,
+# e.g. align_seqs_scores_1hot the dicts of hash_sequences_1hot and
+# hash_scores, which are run untimed if they were not selected.
+#
+# Output
+#  results:  List of dicts with stage, seconds, peak_mb and records_per_s.
+################################################################################
+def bench_stages(stages, fasta_file, scores_file, h5_file, options):
+    extend_len = options.extend_length
+    state = {}
+
+    def seq_vecs():
+        if 'seq_vecs' not in state:
+            state['seq_vecs'] = dna_io.hash_sequences_1hot(fasta_file, extend_len)
+        return state['seq_vecs']
+
+    def seq_scores():
+        if 'seq_scores' not in state:
+            state['seq_scores'] = dna_io.hash_scores(scores_file)
+        return state['seq_scores']
+
+    def fasta_seqs():
+        if 'seqs' not in state:
+            headers, seqs, seq_lens = dna_io.load_fasta(fasta_file)
+            state['seqs'] = seqs
+            state['seq_len'] = extend_len or int(seq_lens.max())
+        return state['seqs'], state['seq_len']
+
+    def one_hot_all():
+        seqs, seq_len = fasta_seqs()
+        for seq in seqs:
+            dna_io.dna_one_hot(seq, seq_len)
+
+    def align():
+        scores, annot = seq_scores()
+        return dna_io.align_seqs_scores_1hot(seq_vecs(), scores, annot)
+
+    def decode():
+        return dna_io.vecs2dna(np.vstack(list(seq_vecs().values())))
+
+    def hdf5_write(stream):
+        argv = ['seq_hdf5_v2.py', '-v', '0.1', '-t', '0.1']
+        if extend_len is not None:
+            argv += ['-e', str(extend_len)]
+        if stream:
+            argv.append('--stream')
+        if options.num_labels > 1:
+            argv.append('--pivot')
+        argv += [fasta_file, scores_file, h5_file]
+        return lambda: run_main(seq_hdf5_v2.main, argv)
+
+    # (function, records processed, inputs prepared before timing)
+    stage_funcs = {
+        'hash_sequences_1hot': (lambda: dna_io.hash_sequences_1hot(fasta_file, extend_len), options.num_seqs, []),
+        'dna_one_hot': (one_hot_all, options.num_seqs, [fasta_seqs]),
+        'hash_scores': (lambda: dna_io.hash_scores(scores_file), options.num_seqs * options.num_labels, []),
+        'align_seqs_scores_1hot': (align, options.num_seqs, [seq_vecs, seq_scores]),
+        'vecs2dna': (decode, options.num_seqs, [seq_vecs]),
+        'hdf5_write': (hdf5_write(False), options.num_seqs, []),
+        'hdf5_stream': (hdf5_write(True), options.num_seqs, [])
+    }
+
+    results = []
+    for stage in stages:
+        stage_func, num_records, prepare = stage_funcs[stage]
+        for prepare_func in prepare:
+            prepare_func()
+
+        print('Benchmark %s' % stage, file=sys.stderr)
+        seconds, peak_bytes = time_stage(stage_func, options.repeat)
+        results.append({
+            'stage': stage,
+            'seconds': seconds,
+            'peak_mb': peak_bytes / 2.0**20,
+            'records': num_records,
+            'records_per_s': num_records / seconds if seconds > 0 else None
+        })
+
+    return results
+
+
+################################################################################
+# time_stage
+#
+# Best wall time of repeat runs of stage_func, and the peak memory allocated
+# during one further run under tracemalloc, which also tracks numpy arrays.
+# The traced run is kept apart since tracing slows down Python code.
+################################################################################
+def time_stage(stage_func, repeat):
+    seconds = None
+    for ri in range(repeat):
+        gc.collect()
+        t0 = time.time()
+        stage_func()
+        run_seconds = time.time() - t0
+        if seconds is None or run_seconds < seconds:
+            seconds = run_seconds
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        stage_func()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return seconds, peak_bytes
+
+
+################################################################################
+# run_main
+#
+# Run a command line main() with the given argv, its stdout discarded.
+################################################################################
+def run_main(main_func, argv):
+    sys_argv, sys_stdout = sys.argv, sys.stdout
+    sys.argv = argv
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        main_func()
+    finally:
+        sys.stdout.close()
+        sys.argv, sys.stdout = sys_argv, sys_stdout
+
+
+################################################################################
+# synthetic_fasta
+#
+# Write a gzipped FASTA of random sequences, 60 nucleotides per line.
+#
+# Input
+#  fasta_file:   Output FASTA file.
+#  num_seqs:     Number of records.
+#  len_mean:     Mean record length.
+#  len_sd:       Standard deviation of the normally distributed lengths.
+#  het_density:  Fraction of positions given a heterozygous IUPAC code.
+#  rng:          numpy RandomState.
+#
+# Output
+#  headers:      Record headers.
+#  num_bases:    Total sequence length.
+################################################################################
+def synthetic_fasta(fasta_file, num_seqs, len_mean, len_sd, het_density, rng):
+    seq_lens = np.maximum(1, np.round(rng.normal(len_mean, len_sd, size=num_seqs))).astype('int64') if len_sd > 0 else np.full(num_seqs, len_mean, dtype='int64')
+
+    acgt = np.frombuffer(b'ACGT', dtype='uint8')
+    hets = np.frombuffer(het_nts.encode('ascii'), dtype='uint8')
+
+    headers = []
+    with gzip.open(fasta_file, 'wb') as fasta_out:
+        for i in range(num_seqs):
+            seq = acgt[rng.randint(0, 4, size=seq_lens[i])]
+            het_pos = np.flatnonzero(rng.random_sample(seq_lens[i]) < het_density)
+            seq[het_pos] = hets[rng.randint(0, len(hets), size=len(het_pos))]
+
+            header = 'seq%d' % i
+            headers.append(header)
+            seq = seq.tobytes()
+            lines = [seq[j:j+60] for j in range(0, len(seq), 60)]
+            fasta_out.write(b'>' + header.encode('ascii') + b'\n' + b'\n'.join(lines) + b'\n')
+
+    return headers, int(seq_lens.sum())
+
+
+################################################################################
+# synthetic_scores
+#
+# Write a gzipped melted scores file (header, label, score) with num_labels
+# lines per header and random 0/1 scores.
+################################################################################
+def synthetic_scores(scores_file, headers, num_labels, rng):
+    with gzip.open(scores_file, 'wt') as scores_out:
+        print('id\tlabel\tscore', file=scores_out)
+        for header in headers:
+            for li in range(num_labels):
+                print('%s\tlabel%d\t%d' % (header, li, rng.randint(0, 2)), file=scores_out)
+
+
+################################################################################
+# git_version
+#
+# The git commit of this script's checkout, or None outside a repository.
+################################################################################
+def git_version():
+    try:
+        repo_dir = os.path.dirname(os.path.abspath(__file__))
+        with open(os.devnull, 'w') as null_out:
+            version = subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=repo_dir, stderr=null_out)
+        return version.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+    main()
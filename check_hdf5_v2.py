@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+from __future__ import print_function
+from optparse import OptionParser
+import sys
+
+import dna_io_v2 as dna_io
+
+################################################################################
+# check_hdf5_v2.py
+#
+# Check the sequences of an HDF5 file made by seq_hdf5_v2.py against the FASTA
+# file it was built from, writing a report of mismatching records.
+################################################################################
+
+################################################################################
+# main
+################################################################################
+def main():
+    usage = 'usage: %prog [options] <hdf5_file> <fasta_file> <report_file>'
+    parser = OptionParser(usage)
+    parser.add_option('-b', dest='block_size', default=4096, type='int', help='Sequences compared per block [Default: %default]')
+    parser.add_option('-d', dest='splits', default=None, help='Comma-separated splits to check, in FASTA order [Default: train,valid,test if present]')
+    (options,args) = parser.parse_args()
+
+    if len(args) != 3:
+        parser.error('Must provide HDF5 file, FASTA file and report file')
+    else:
+        hdf5_file = args[0]
+        fasta_file = args[1]
+        report_file = args[2]
+
+    splits = options.splits.split(',') if options.splits else None
+
+    try:
+        num_checked, num_mismatched = dna_io.validate_hdf5(hdf5_file, fasta_file, report_file, options.block_size, splits)
+    except ValueError as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    print('%d sequences checked, %d mismatched' % (num_checked, num_mismatched), file=sys.stderr)
+
+    if num_mismatched > 0:
+        sys.exit(1)
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+    main()
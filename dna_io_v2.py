@@ -1,24 +1,109 @@
 #!/usr/bin/env python
 from __future__ import print_function
+import array
+import hashlib
+import os
 import sys
-from collections import OrderedDict
+import itertools
+import multiprocessing
+import tempfile
+from collections import OrderedDict, deque
 
 import numpy as np
 import numpy.random as npr
+import pandas as pd
 from sklearn import preprocessing
 import gzip
 import pdb
 
+import run_stats_v2 as run_stats
+
 ################################################################################
 # dna_io.py
 #
 # Methods to load the training data.
 ################################################################################
 
+################################################################################
+# IUPAC lookup tables
+#
+# Every position is one of a few categories, numbered by nucleotide codes:
+#  A C G T M R W S Y K N pad
+#  0 1 2 3 4 5 6 7 8 9 10 11
+#
+# nt_codes maps every byte value to its code and code_vecs maps codes to their
+# A C G T rows; nt_lut composes the two, so sequences are encoded with one
+# fancy index instead of a loop over positions. Either case of ACGT and the
+# two-nucleotide ambiguity codes are recognised; any other byte (N, gaps, ...)
+# is coded as N, 0.25 in every channel like the padding.
+################################################################################
+iupac_channels = OrderedDict([
+    ('A', (0,)),
+    ('C', (1,)),
+    ('G', (2,)),
+    ('T', (3,)),
+    ('M', (0,1)),
+    ('R', (0,2)),
+    ('W', (0,3)),
+    ('S', (1,2)),
+    ('Y', (1,3)),
+    ('K', (2,3))])
+
+code_nts = b'ACGTMRWSYKNN'
+n_code = 10
+pad_code = 11
+
+def make_nt_codes():
+    codes = np.full(256, n_code, dtype='uint8')
+    for ci, nt in enumerate(iupac_channels):
+        codes[ord(nt)] = ci
+        codes[ord(nt.lower())] = ci
+    return codes
+
+def make_code_vecs():
+    vecs = np.full((len(code_nts),4), 0.25, dtype='float16')
+    for ci, channels in enumerate(iupac_channels.values()):
+        vecs[ci] = 0
+        vecs[ci,list(channels)] = 1.0 / len(channels)
+    return vecs
+
+nt_codes = make_nt_codes()
+code_vecs = make_code_vecs()
+nt_lut = code_vecs[nt_codes]
+
+################################################################################
+# Decoding goes the other way: each 4-vector is counted in quarters, 0-4 per
+# channel, and folded into a base 5 key that vec_key_codes maps back to its
+# code. Vectors that are not quarters, or whose key is not a code's vector,
+# decode to bad_code.
+################################################################################
+bad_code = 255
+bad_key = 5**4
+
+def make_vec_key_codes():
+    key_codes = np.full(bad_key+1, bad_code, dtype='uint8')
+    for ci in range(n_code, -1, -1):
+        key_codes[vec_keys(code_vecs[ci].reshape((1,4,1)))[0,0]] = ci
+    return key_codes
+
+def vec_keys(seq_vecs):
+    quarters = np.asarray(seq_vecs, dtype='float32') * 4
+    counts = np.rint(quarters)
+    valid = ((counts == quarters) & (counts >= 0) & (counts <= 4)).all(axis=1)
+
+    counts = counts.astype('int16')
+    keys = counts[:,0] + 5*counts[:,1] + 25*counts[:,2] + 125*counts[:,3]
+    keys[~valid] = bad_key
+    return keys
+
+vec_key_codes = make_vec_key_codes()
+
+
 ################################################################################
 # align_seqs_scores
 #
 # Align entries from input dicts into numpy matrices ready for analysis.
+# Sequences without scores are dropped, see join_headers.
 #
 # Input
 #  seq_vecs:      Dict mapping headers to sequence vectors.
@@ -32,88 +117,481 @@ def align_seqs_scores_1hot(seq_vecs, seq_scores, seq_annot, sort=True):
     if sort:
         seq_headers = sorted(seq_vecs.keys())
     else:
-        seq_headers = seq_vecs.keys()
+        seq_headers = list(seq_vecs.keys())
 
-    # construct lists of vectors
-    train_scores = []
-    train_seqs = []
-    train_annot = []
-    for header in seq_headers:
-        train_seqs.append(seq_vecs[header])
-        train_scores.append(seq_scores[header])
-        train_annot.append(seq_annot[header])
+    seq_rows, score_rows = join_headers(seq_headers, list(seq_scores.keys()))
+    seq_headers = [seq_headers[i] for i in seq_rows]
 
     # stack into matrices
-    train_seqs = np.vstack(train_seqs)
-    train_scores = np.vstack(train_scores)
-    train_annot = np.vstack(train_annot)
+    train_seqs = np.vstack([seq_vecs[header] for header in seq_headers])
+    train_scores = np.vstack([seq_scores[header] for header in seq_headers])
+    train_annot = np.vstack([seq_annot[header] for header in seq_headers])
 
     return train_seqs, train_scores, train_annot
 
 
+################################################################################
+# align_seqs_scores_batch
+#
+# Like align_seqs_scores_1hot, but starting from the FASTA records and score
+# columns: headers are joined through a hash index, sequences are encoded
+# straight into one preallocated matrix and the scores and annotations are
+# gathered with one take each. Scores of several labels per header need
+# pivot, one column per label (see pivot_scores); without it they raise a
+# ValueError rather than keep only the last label.
+#
+# Input
+#  headers:       FASTA headers.
+#  seqs:          FASTA sequences.
+#  seq_lens:      Array of sequence lengths.
+#  score_cols:    (headers, label_codes, labels, scores) from read_scores.
+#  extend_len:    Extend the sequences to this length.
+#  sort:          Order rows by header rather than by FASTA position.
+#  workers:       Number of encoding processes.
+#  pivot:         One score column per label, aligned to annot_labels.
+#  pivot_fill:    Score of (header, label) pairs without a line with pivot.
+#
+# Output
+#  train_seqs:    Matrix with sequence vector rows.
+#  train_scores:  Matrix with score vector rows.
+#  train_annot:   int32 array of each row's annotation code, None with pivot.
+#  train_headers: Array of headers in row order.
+#  annot_labels:  Sorted annotation labels the codes, or columns, index.
+#  train_records: int64 array of each row's FASTA record position.
+################################################################################
+def align_seqs_scores_batch(headers, seqs, seq_lens, score_cols, extend_len=None, sort=True, workers=1, pivot=False, pivot_fill=0):
+    score_headers, label_codes, labels, scores = score_cols
+    headers = np.array(headers, dtype='S')
+
+    # empty records are dropped, as in hash_sequences_1hot
+    seq_rows = np.flatnonzero(seq_lens > 0)
+    if sort:
+        seq_rows = seq_rows[np.argsort(headers[seq_rows], kind='mergesort')]
+
+    match_rows, score_rows = join_headers(headers[seq_rows], score_headers)
+    seq_rows = seq_rows[match_rows]
+
+    if extend_len is not None:
+        seq_len = extend_len
+    else:
+        seq_len = int(seq_lens[seq_rows].max())
+
+    # encode into N x 4 x 1 x seq_len and view as rows
+    train_seqs = encode_batch([seqs[i] for i in seq_rows], seq_len, workers=workers)
+    train_seqs = train_seqs.reshape((len(seq_rows), -1))
+
+    if pivot:
+        annot_labels, indptr, indices, data = pivot_scores(headers[seq_rows], score_cols)
+        train_scores = csr_dense(indptr, indices, data, np.arange(len(seq_rows)), len(annot_labels), pivot_fill, pivot_dtype(scores.dtype, pivot_fill))
+        train_annot = None
+    else:
+        check_single_label(score_cols, headers[seq_rows])
+        train_scores = scores[score_rows][:,None]
+
+        annot_labels, label_map = sort_labels(label_codes[score_rows], labels)
+        train_annot = label_map[label_codes[score_rows]]
+
+    return train_seqs, train_scores, train_annot, headers[seq_rows], annot_labels, seq_rows
+
+
+################################################################################
+# sort_labels
+#
+# Code annotations by their sorted labels, e.g. the target_labels table
+# written to HDF5, rather than carrying label strings per record.
+#
+# Input
+#  label_codes:  Label codes of the records, e.g. from read_scores.
+#  labels:       Labels the codes index.
+#
+# Output
+#  label_table:  Sorted distinct labels used by label_codes.
+#  label_map:    int32 map from codes into labels to codes into label_table,
+#                -1 for unused labels.
+################################################################################
+def sort_labels(label_codes, labels):
+    used = np.unique(label_codes)
+    used = used[np.argsort(labels[used], kind='mergesort')]
+
+    label_map = np.full(len(labels), -1, dtype='int32')
+    label_map[used] = np.arange(len(used))
+
+    return labels[used], label_map
+
+
+################################################################################
+# label_rows
+#
+# Rows of a split whose annotation (prefix_annot) is the given label.
+################################################################################
+def label_rows(h5f, prefix, label):
+    label_code = np.flatnonzero(h5f['target_labels'][()] == np.asarray(label, dtype=h5f['target_labels'].dtype))
+    if len(label_code) == 0:
+        return np.zeros(0, dtype='int64')
+    return np.flatnonzero(h5f['%s_annot' % prefix][()] == label_code[0])
+
+
+################################################################################
+# pivot_scores
+#
+# Pivot melted score lines into a records x labels matrix in CSR form, one
+# column per distinct label. Lines whose header is no record are dropped, and
+# of repeated (header, label) lines the last is used, as in join_headers.
+# Records sharing a header share its scores.
+#
+# Input
+#  headers:        Record headers, e.g. from the FASTA file.
+#  score_cols:     (headers, label_codes, labels, scores) from read_scores.
+#
+# Output
+#  target_labels:  Sorted labels of the columns.
+#  indptr:         int64 array; record i's entries are [indptr[i], indptr[i+1]).
+#  indices:        int32 column of each entry, ascending within a record.
+#  data:           Score of each entry.
+################################################################################
+def pivot_scores(headers, score_cols):
+    score_headers, label_codes, labels, scores = score_cols
+
+    # distinct score header of each line, and of each record
+    line_keys, key_headers = pd.factorize(score_headers)
+    record_keys = pd.Index(key_headers).get_indexer(np.asarray(headers, dtype=key_headers.dtype))
+
+    # columns over the labels of lines that reach a record
+    key_used = np.zeros(len(key_headers), dtype='bool')
+    key_used[record_keys[record_keys >= 0]] = True
+    line_used = key_used[line_keys]
+    target_labels = np.unique(labels[np.unique(label_codes[line_used])])
+    label_cols = np.full(len(labels), -1, dtype='int32')
+    label_order = np.argsort(labels)
+    label_cols[label_order[np.searchsorted(labels, target_labels, sorter=label_order)]] = np.arange(len(target_labels))
+    line_cols = label_cols[label_codes]
+
+    # sort lines by (key, column), keeping the last of each pair
+    lines = np.flatnonzero(line_used)
+    lines = lines[np.lexsort((lines, line_cols[lines], line_keys[lines]))]
+    pair = line_keys[lines].astype('int64') * max(len(target_labels), 1) + line_cols[lines]
+    last = np.ones(len(pair), dtype='bool')
+    last[:-1] = pair[1:] != pair[:-1]
+    lines = lines[last]
+
+    key_ptr = np.zeros(len(key_headers)+1, dtype='int64')
+    key_ptr[1:] = np.cumsum(np.bincount(line_keys[lines], minlength=len(key_headers)))
+
+    # gather each record's key entries
+    record_found = record_keys >= 0
+    record_lens = np.zeros(len(record_keys), dtype='int64')
+    record_lens[record_found] = np.diff(key_ptr)[record_keys[record_found]]
+    indptr = np.zeros(len(record_keys)+1, dtype='int64')
+    indptr[1:] = np.cumsum(record_lens)
+
+    starts = np.zeros(len(record_keys), dtype='int64')
+    starts[record_found] = key_ptr[record_keys[record_found]]
+    entries = lines[np.repeat(starts - indptr[:-1], record_lens) + np.arange(indptr[-1])]
+
+    return target_labels, indptr, line_cols[entries], scores[entries]
+
+
+################################################################################
+# pivot_dtype
+#
+# dtype of pivoted scores: that of the scores, unless the fill value, e.g.
+# nan, needs a float.
+################################################################################
+def pivot_dtype(score_dtype, fill):
+    if float(fill).is_integer():
+        return np.dtype(score_dtype)
+    return np.result_type(score_dtype, np.float32)
+
+
+################################################################################
+# check_single_label
+#
+# Raise a ValueError if any of the headers has score lines of more than one
+# label, which a single target column cannot hold; see pivot_scores.
+################################################################################
+def check_single_label(score_cols, headers):
+    score_headers, label_codes, labels, scores = score_cols
+
+    line_keys, key_headers = pd.factorize(score_headers)
+    pairs = np.unique(line_keys.astype('int64') * len(labels) + label_codes)
+    key_labels = np.bincount(pairs // len(labels), minlength=len(key_headers))
+
+    multi_headers = key_headers[key_labels > 1]
+    multi_headers = multi_headers[pd.Index(multi_headers).isin(np.asarray(headers, dtype=multi_headers.dtype))]
+    if len(multi_headers) > 0:
+        shown = np.asarray(multi_headers[:5]).astype(str)
+        raise ValueError('%d sequences have scores of several labels, e.g. %s; pivot them into one target column per label (seq_hdf5_v2 --pivot)' % (len(multi_headers), ', '.join(shown)))
+
+
+################################################################################
+# csr_dense
+#
+# Densify rows of a CSR matrix.
+#
+# Input
+#  indptr, indices, data:  CSR matrix, see pivot_scores.
+#  rows:      Rows to densify.
+#  num_cols:  Number of columns.
+#  fill:      Value of the entries not stored.
+#  dtype:     Output dtype [Default: data's].
+#
+# Output
+#  dense:     len(rows) x num_cols array.
+################################################################################
+def csr_dense(indptr, indices, data, rows, num_cols, fill=0, dtype=None):
+    rows = np.asarray(rows)
+    starts = indptr[rows]
+    lens = indptr[rows+1] - starts
+
+    dense = np.full((len(rows), num_cols), fill, dtype=dtype or data.dtype)
+    offsets = np.cumsum(lens) - lens
+    entries = np.repeat(starts - offsets, lens) + np.arange(lens.sum())
+    dense[np.repeat(np.arange(len(rows)), lens), indices[entries]] = data[entries]
+
+    return dense
+
+
+################################################################################
+# join_headers
+#
+# Match headers against the headers of another table through a hash index.
+# When index_headers repeats a header, its last row is used.
+#
+# Input
+#  headers:        Headers to look up, e.g. from the FASTA file.
+#  index_headers:  Headers of the table to gather from, e.g. the scores.
+#  missing:        'filter' drops and reports headers that are not found,
+#                  'error' raises a KeyError listing them.
+#
+# Output
+#  rows:           Positions in headers that were found.
+#  index_rows:     Matching positions in index_headers.
+################################################################################
+def join_headers(headers, index_headers, missing='filter'):
+    index = pd.Index(index_headers)
+    index_rows = np.arange(len(index))
+    if not index.is_unique:
+        last = ~index.duplicated(keep='last')
+        index = index[last]
+        index_rows = index_rows[last]
+
+    lookup = index.get_indexer(headers)
+    found = lookup >= 0
+
+    if not found.all():
+        missing_headers = np.asarray([headers[i] for i in np.flatnonzero(~found)[:5]]).astype(str)
+        msg = '%d of %d sequences have no scores, e.g. %s' % ((~found).sum(), len(found), ', '.join(missing_headers))
+        if missing == 'error':
+            raise KeyError(msg)
+        print(msg + '; dropping them', file=sys.stderr)
+
+    rows = np.flatnonzero(found)
+    return rows, index_rows[lookup[rows]]
+
+
+################################################################################
+# hash_split
+#
+# Assign records to train, valid and test by a seeded hash of a key, so a
+# record's split depends only on its key and the seed: it is stable across
+# rebuilds and record orders, and records sharing a key, e.g. a region or an
+# individual, always share a split.
+#
+# Input
+#  keys:       Key of each record, bytes or str.
+#  valid_pct:  Fraction of keys sent to valid.
+#  test_pct:   Fraction of keys sent to test.
+#  seed:       Seed mixed into the hash.
+#
+# Output
+#  splits:     int8 array, 0 train, 1 valid, 2 test.
+################################################################################
+def hash_split(keys, valid_pct, test_pct, seed=1):
+    key_codes, unique_keys = pd.factorize(np.asarray(keys))
+
+    salt = ('%d:' % seed).encode('ascii')
+    digests = b''.join(hashlib.md5(salt + (key if isinstance(key, bytes) else key.encode('utf-8'))).digest()[:8] for key in unique_keys)
+    unit = np.frombuffer(digests, dtype='>u8') / float(2**64)
+
+    key_splits = np.zeros(len(unique_keys), dtype='int8')
+    key_splits[unit < test_pct + valid_pct] = 1
+    key_splits[unit < test_pct] = 2
+
+    return key_splits[key_codes]
+
+
 ################################################################################
 # check_order
 #
 # Check that the order of sequences in a matrix of vectors matches the order
-# in the given fasta file
+# in the given fasta file. Mismatches, and FASTA records beyond the rows,
+# are printed; returns whether all match.
 ################################################################################
 def check_order(seq_vecs, fasta_file):
     # reshape into seq x 4 x len
-    seq_mats = np.reshape(seq_vecs, (seq_vecs.shape[0], 4, seq_vecs.shape[1]/4))
-
-    # generate sequences
-    real_seqs = []
-    for i in range(seq_mats.shape[0]):
-        seq_list = ['']*seq_mats.shape[2]
-        for j in range(seq_mats.shape[2]):
-            if seq_mats[i,0,j] == 1:
-                seq_list[j] = 'A'
-            elif seq_mats[i,1,j] == 1:
-                seq_list[j] = 'C'
-            elif seq_mats[i,2,j] == 1:
-                seq_list[j] = 'G'
-            elif seq_mats[i,3,j] == 1:
-                seq_list[j] = 'T'
-
-            # GEH 11/10/17
-            # ambiguity codes
-            # A C G T
-            # 0 1 2 3 
-            elif (seq_mats[i,0,j] == 0.5) and seq_mats[i,1,j] == 0.5:
-                seq_list[j] = 'M'
-            elif (seq_mats[i,0,j] == 0.5) and seq_mats[i,2,j] == 0.5:
-                seq_list[j] = 'W'
-            elif (seq_mats[i,0,j] == 0.5) and seq_mats[i,3,j] == 0.5:
-                seq_list[j] = 'T'
-            elif (seq_mats[i,1,j] == 0.5) and seq_mats[i,2,j] == 0.5:
-                seq_list[j] = 'S'
-            elif (seq_mats[i,1,j] == 0.5) and seq_mats[i,3,j] == 0.5:
-                seq_list[j] = 'Y'
-            elif (seq_mats[i,2,j] == 0.5) and seq_mats[i,3,j] == 0.5:
-                seq_list[j] = 'K'
+    seq_mats = np.reshape(seq_vecs, (seq_vecs.shape[0], 4, seq_vecs.shape[1]//4))
 
-            else:
-                seq_list[j] = 'N'
-        real_seqs.append(''.join(seq_list))
-
-    # load FASTA sequences
-    fasta_seqs = []
-    for line in gzip.open(fasta_file):
-        if line[0] == '>':
-            fasta_seqs.append('')
-        else:
-            fasta_seqs[-1] += line.rstrip()
+    records = ((header, seq) for header, seq in read_fasta(fasta_file) if seq)
+    num_checked, num_mismatched = compare_fasta_codes(vecs2codes(seq_mats), records, sys.stdout)
 
-    # check
-    assert(len(real_seqs) == len(fasta_seqs))
+    # FASTA records left over, e.g. dropped for lack of scores
+    num_extra = sum(1 for record in records)
+    if num_extra > 0:
+        print('\t'.join(['fasta','-','-','%d records beyond the %d rows' % (num_extra, seq_mats.shape[0]),'','','']))
 
-    for i in range(len(fasta_seqs)):
-        try:
-            assert(fasta_seqs[i] == real_seqs[i])
-        except:
-            print(fasta_seqs[i])
-            print(real_seqs[i])
-            exit()
+    return num_checked == seq_mats.shape[0] and num_mismatched == 0 and num_extra == 0
+
+
+################################################################################
+# validate_hdf5
+#
+# Check the sequences of an HDF5 file written by seq_hdf5_v2 against the
+# source FASTA, block by block. Each row is matched to
+# its FASTA record through prefix_records, so permuted (-r), hash split and
+# filtered files are checked as well, and compared as nucleotide codes
+# (padding counts as N) after decoding its layout with read_seqs. When rows
+# follow FASTA order, the FASTA is read once alongside them in constant
+# memory; permuted files (-r, --hash_split, --vt) spill the records once
+# and read them back in row order, see permute_records. Files grown with
+# --append are checked against their FASTA files
+# concatenated in order. FASTA records without a row, e.g. for lack of
+# scores, are not reported.
+#
+# Input
+#  h5_file:      HDF5 file.
+#  fasta_file:   FASTA file the HDF5 file was built from.
+#  report_file:  Optional path of a tab-separated mismatch report.
+#  block_size:   Rows read per block.
+#  splits:       Splits to check, e.g. train [Default: all].
+#
+# Output
+#  num_checked:     Number of rows compared.
+#  num_mismatched:  Number of mismatching (or missing) records.
+################################################################################
+def validate_hdf5(h5_file, fasta_file, report_file=None, block_size=4096, splits=None):
+    import h5py
+
+    h5f = h5py.File(h5_file, 'r')
+    if splits is None:
+        splits = [prefix for prefix in ['train','valid','test'] if any('%s_%s' % (prefix, part) in h5f for part in ['in','window','index'])]
+
+    for prefix in splits:
+        if '%s_records' % prefix not in h5f:
+            h5f.close()
+            raise ValueError('%s has no %s_records to match its rows to FASTA records; rebuild it with seq_hdf5_v2.py to check it' % (h5_file, prefix))
+
+    # FASTA record of every row, split after split, read in blocks
+    def record_blocks():
+        for prefix in splits:
+            split_records = h5f['%s_records' % prefix]
+            for r0 in range(0, split_records.shape[0], block_size):
+                yield split_records[r0:r0+block_size]
+    row_records = lambda: itertools.chain.from_iterable(record_blocks())
+
+    in_order = True
+    last_ri = -1
+    for block_records in record_blocks():
+        if len(block_records) > 0:
+            if block_records[0] < last_ri or (np.diff(block_records) < 0).any():
+                in_order = False
+                break
+            last_ri = block_records[-1]
+
+    # a row past the end of the FASTA ends the records early, and the rest
+    # are reported missing
+    if in_order:
+        records = fasta_rows(read_fasta(fasta_file), row_records())
+    else:
+        # the FASTA is counted as it is spilled
+        num_fasta = [0]
+        def fasta_records():
+            for record in read_fasta(fasta_file):
+                num_fasta[0] += 1
+                yield record
+        order = itertools.takewhile(lambda ri: ri < num_fasta[0], row_records())
+        records = permute_records(fasta_records(), order)
+
+    report_out = open(report_file, 'w') if report_file else None
+    if report_out:
+        print('\t'.join(['split','row','header','mismatches','positions','expected','observed']), file=report_out)
+
+    num_checked = 0
+    num_mismatched = 0
+    for prefix in splits:
+        split_rows = num_seqs(h5f, prefix)
+        for b0 in range(0, split_rows, block_size):
+            b1 = min(b0+block_size, split_rows)
+            block_codes = vecs2codes(read_seqs(h5f, prefix, b0, b1))
+
+            block_records = itertools.islice(records, len(block_codes))
+            block_checked, block_mismatched = compare_fasta_codes(block_codes, block_records, report_out, prefix, b0)
+            num_checked += block_checked
+            num_mismatched += block_mismatched
+
+    if report_out:
+        report_out.close()
+    h5f.close()
+
+    return num_checked, num_mismatched
+
+
+################################################################################
+# fasta_rows
+#
+# Yield the FASTA record of each row, given the rows' non-decreasing record
+# positions, in one pass over the records; stops at the end of the FASTA.
+################################################################################
+def fasta_rows(records, row_records):
+    records = iter(records)
+    ri, record = -1, None
+    for row_ri in row_records:
+        while ri < row_ri:
+            record = next(records, None)
+            if record is None:
+                return
+            ri += 1
+        yield record
+
+
+################################################################################
+# compare_fasta_codes
+#
+# Compare decoded rows against the next FASTA records, one per row, and
+# write one report line per mismatching record. Records past the rows are
+# left in the iterator.
+#
+# Input
+#  seq_codes:   N x L nucleotide codes decoded from the data.
+#  records:     Iterator of (header, seq) FASTA records for those rows.
+#  report_out:  Open file for the report, or None.
+#  name, row0:  Split or dataset name and first row, for the report.
+################################################################################
+def compare_fasta_codes(seq_codes, records, report_out, name='-', row0=0, max_positions=20):
+    headers, seqs = [], []
+    for header, seq in itertools.islice(records, len(seq_codes)):
+        headers.append(header)
+        seqs.append(seq)
+
+    seq_codes = np.where(seq_codes == pad_code, n_code, seq_codes)
+    fasta_codes = encode_codes_batch(seqs, seq_codes.shape[1])
+    fasta_codes[fasta_codes == pad_code] = n_code
+
+    num_mismatched = len(seq_codes) - len(seqs)
+    if num_mismatched > 0 and report_out:
+        print('\t'.join([name, str(row0+len(seqs)), '-', 'FASTA ended after %d rows' % (row0+len(seqs)), '', '', '']), file=report_out)
+
+    differ = seq_codes[:len(seqs)] != fasta_codes
+    for i in np.flatnonzero(differ.any(axis=1)):
+        num_mismatched += 1
+        if report_out:
+            positions = np.flatnonzero(differ[i])
+            shown = positions[:max_positions]
+            expected = codes2dna(fasta_codes[i,shown][None,:])[0]
+            observed = codes2dna(seq_codes[i,shown][None,:])[0]
+            header = headers[i].decode('ascii', 'replace') if isinstance(headers[i], bytes) else headers[i]
+            print('\t'.join([name, str(row0+i), header, str(len(positions)), ','.join(map(str, shown)), expected, observed]), file=report_out)
+
+    return len(seqs), num_mismatched
 
 
 ################################################################################
@@ -144,96 +622,591 @@ def dna_one_hot(seq, seq_len=None):
             # print >> sys.stderr, 'Non-ACGT nucleotide encountered'
             seq_code[:,i] = 0.25
 
-    # flatten and make a column vector 1 x len(seq)
-    seq_vec = seq_code.flatten()[None,:]
+    # flatten and make a column vector 1 x len(seq)
+    seq_vec = seq_code.flatten()[None,:]
+
+    return seq_vec
+'''
+
+def dna_one_hot(seq, seq_len=None, flatten=True):
+    if seq_len == None:
+        seq_len = len(seq)
+
+    # map nt's to a matrix 4 x len(seq) of 0's and 1's.
+    #  dtype='int8' fails for N's
+    seq_code = np.empty((4,seq_len), dtype='float16')
+    one_hot_fill(seq, seq_code)
+
+    # flatten and make a column vector 1 x len(seq)
+    if flatten:
+        seq_vec = seq_code.flatten()[None,:]
+    else:
+        seq_vec = seq_code
+
+    return seq_vec
+
+
+################################################################################
+# one_hot_fill
+#
+# Encode a sequence into an existing 4 x seq_len array (or view), trimming
+# around the center if the sequence is too long and padding both sides with
+# 0.25 if it is too short.
+#
+# Input
+#  seq:       Sequence as str, bytes or a uint8 array of ASCII codes.
+#  seq_code:  4 x seq_len float array to fill.
+################################################################################
+def one_hot_fill(seq, seq_code):
+    nts, seq_start = center_seq(seq, seq_code.shape[-1])
+    seq_end = seq_start + len(nts)
+
+    seq_code[:,:seq_start] = 0.25
+    seq_code[:,seq_start:seq_end] = nt_lut[nts].T
+    seq_code[:,seq_end:] = 0.25
+
+
+################################################################################
+# codes_fill
+#
+# Like one_hot_fill, but write uint8 nucleotide codes into a seq_len vector,
+# with pad_code for the padding.
+################################################################################
+def codes_fill(seq, seq_codes):
+    nts, seq_start = center_seq(seq, seq_codes.shape[-1])
+    seq_end = seq_start + len(nts)
+
+    seq_codes[:seq_start] = pad_code
+    seq_codes[seq_start:seq_end] = nt_codes[nts]
+    seq_codes[seq_end:] = pad_code
+
+
+################################################################################
+# center_seq
+#
+# Trim a sequence around its center to at most seq_len bytes.
+#
+# Output
+#  nts:        uint8 array of the kept bytes.
+#  seq_start:  Offset of the kept bytes when centered in seq_len.
+################################################################################
+def center_seq(seq, seq_len):
+    nts = seq_bytes(seq)
+
+    if seq_len <= len(nts):
+        # trim the sequence
+        seq_trim = (len(nts)-seq_len) // 2
+        nts = nts[seq_trim:seq_trim+seq_len]
+        seq_start = 0
+    else:
+        seq_start = (seq_len-len(nts)) // 2
+
+    return nts, seq_start
+
+
+################################################################################
+# encode_batch
+#
+# Encode many sequences directly into one contiguous array in the
+# N x 4 x 1 x seq_len layout used for Torch.
+#
+# Input
+#  seqs:     Sequences (str, bytes or uint8 arrays).
+#  seq_len:  Trim or pad every sequence to this length.
+#  out:      Optional preallocated array of at least len(seqs) rows to fill.
+#  workers:  Number of encoding processes (see encode_blocks).
+#
+# Output
+#  seqs_1hot: N x 4 x 1 x seq_len float16 array (out, if given).
+################################################################################
+def encode_batch(seqs, seq_len, out=None, workers=1):
+    if out is None:
+        out = np.empty((len(seqs),4,1,seq_len), dtype='float16')
+    elif out.shape[1:] != (4,1,seq_len):
+        raise ValueError('encode_batch output must be N x 4 x 1 x %d, not %s' % (seq_len, str(out.shape)))
+
+    if workers > 1:
+        block_size = max(1, min(4096, len(seqs) // (2*workers)))
+        i = 0
+        for block_headers, block_1hot in encode_blocks(enumerate(seqs), seq_len, block_size, workers):
+            out[i:i+len(block_1hot)] = block_1hot
+            i += len(block_1hot)
+    else:
+        for i, seq in enumerate(seqs):
+            one_hot_fill(seq, out[i,:,0,:])
+
+    return out
+
+
+################################################################################
+# encode_codes_batch
+#
+# Encode many sequences into an N x seq_len uint8 array of nucleotide codes,
+# an eighth of the size of the float16 one hot coding.
+#
+# Input
+#  seqs:     Sequences (str, bytes or uint8 arrays).
+#  seq_len:  Trim or pad every sequence to this length.
+#  out:      Optional preallocated array of at least len(seqs) rows to fill.
+#
+# Output
+#  seqs_codes: N x seq_len uint8 array (out, if given).
+################################################################################
+def encode_codes_batch(seqs, seq_len, out=None):
+    if out is None:
+        out = np.empty((len(seqs),seq_len), dtype='uint8')
+    elif out.shape[1:] != (seq_len,):
+        raise ValueError('encode_codes_batch output must be N x %d, not %s' % (seq_len, str(out.shape)))
+
+    for i, seq in enumerate(seqs):
+        codes_fill(seq, out[i])
+
+    return out
+
+
+################################################################################
+# decode_codes
+#
+# Expand nucleotide codes to the float16 one hot coding.
+#
+# Input
+#  seqs_codes:  N x seq_len array of nucleotide codes.
+#  out:         Optional preallocated N x 4 x 1 x seq_len array to fill.
+#  table:       Code to A C G T table, e.g. as stored with the codes.
+#
+# Output
+#  seqs_1hot:   N x 4 x 1 x seq_len float16 array (out, if given).
+################################################################################
+def decode_codes(seqs_codes, out=None, table=code_vecs):
+    num_seqs, seq_len = seqs_codes.shape
+    if out is None:
+        out = np.empty((num_seqs,4,1,seq_len), dtype='float16')
+
+    # table.T[:,codes] is 4 x N x seq_len
+    out[:,:,0,:] = np.swapaxes(np.asarray(table).T[:,seqs_codes], 0, 1)
+
+    return out
+
+
+################################################################################
+# encode_blocks
+#
+# Encode (header, seq) records in blocks, yielding the blocks in input order.
+#
+# With more than one worker, blocks are encoded by a process pool into slots
+# of a memory-mapped scratch file, so only the raw sequence bytes are pickled
+# to the workers and nothing is pickled back. Up to two blocks per worker are
+# in flight while the caller keeps reading records; the scratch file holds
+# 2 * workers * block_size encoded sequences.
+#
+# Input
+#  records:     Iterable of (header, seq).
+#  seq_len:     Trim or pad every sequence to this length.
+#  block_size:  Sequences per block.
+#  workers:     Number of encoding processes; 1 encodes in this process.
+#  codes:       Encode uint8 nucleotide codes rather than one hot.
+#
+# Output
+#  Generator of (headers, seqs_1hot) pairs, where seqs_1hot is a
+#  block x 4 x 1 x seq_len array (block x seq_len codes) only valid until
+#  the next block is read.
+################################################################################
+def encode_blocks(records, seq_len, block_size, workers=1, codes=False):
+    if codes:
+        block_shape, block_dtype = (block_size,seq_len), 'uint8'
+    else:
+        block_shape, block_dtype = (block_size,4,1,seq_len), 'float16'
+
+    if workers <= 1:
+        block_1hot = np.empty(block_shape, dtype=block_dtype)
+        for headers, seqs in record_blocks(records, block_size):
+            encode_scratch_block(seqs, seq_len, block_1hot, codes)
+            yield headers, block_1hot[:len(seqs)]
+        return
+
+    num_slots = 2*workers
+    scratch_shape = (num_slots,) + block_shape
+    scratch_fd, scratch_file = tempfile.mkstemp(suffix='.1hot')
+    os.close(scratch_fd)
+
+    scratch = np.memmap(scratch_file, dtype=block_dtype, mode='w+', shape=scratch_shape)
+    pool = multiprocessing.Pool(workers)
+    pending = deque()
+
+    try:
+        for bi, (headers, seqs) in enumerate(record_blocks(records, block_size)):
+            # a full ring means the oldest slot is next; hand it over first
+            if len(pending) == num_slots:
+                slot, slot_headers, result = pending.popleft()
+                result.get()
+                yield slot_headers, scratch[slot,:len(slot_headers)]
+
+            slot = bi % num_slots
+            result = pool.apply_async(encode_scratch, (scratch_file, block_dtype, scratch_shape, slot, seqs, seq_len, codes))
+            pending.append((slot, headers, result))
+
+        while pending:
+            slot, slot_headers, result = pending.popleft()
+            result.get()
+            yield slot_headers, scratch[slot,:len(slot_headers)]
+
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+        del scratch
+        os.remove(scratch_file)
+
+
+################################################################################
+# encode_scratch
+#
+# Worker side of encode_blocks: encode seqs into one slot of the scratch file.
+################################################################################
+def encode_scratch(scratch_file, scratch_dtype, scratch_shape, slot, seqs, seq_len, codes):
+    scratch = np.memmap(scratch_file, dtype=scratch_dtype, mode='r+', shape=scratch_shape)
+    encode_scratch_block(seqs, seq_len, scratch[slot], codes)
+    del scratch
+
+
+################################################################################
+# encode_scratch_block
+#
+# Encode seqs into a preallocated block, as codes or one hot vectors.
+################################################################################
+def encode_scratch_block(seqs, seq_len, block, codes):
+    if codes:
+        encode_codes_batch(seqs, seq_len, block)
+    else:
+        encode_batch(seqs, seq_len, block)
+
+
+################################################################################
+# record_blocks
+#
+# Group (header, seq) records into lists of at most block_size.
+################################################################################
+def record_blocks(records, block_size):
+    records = iter(records)
+    while True:
+        block = list(itertools.islice(records, block_size))
+        if not block:
+            break
+        yield [header for header, seq in block], [seq for header, seq in block]
+
+
+################################################################################
+# permute_records
+#
+# Yield records in a permuted order without holding them in memory: the
+# sequences are spilled to a scratch file in one pass and read back from a
+# memory map of it in the new order.
+#
+# Input
+#  records:  Iterator of (key, seq) records.
+#  order:    Permutation of the record positions, e.g. npr.permutation(n).
+#
+# Output
+#  Generator of (key, seq) records, record order[i] as the i'th, with seq a
+#  uint8 array.
+################################################################################
+def permute_records(records, order):
+    scratch = tempfile.TemporaryFile()
+    keys = []
+    offsets = array.array('q', [0])
+    for key, seq in records:
+        seq = seq_bytes(seq)
+        scratch.write(seq.tobytes())
+        keys.append(key)
+        offsets.append(offsets[-1] + len(seq))
+    scratch.flush()
+
+    try:
+        if offsets[-1] > 0:
+            seqs = np.memmap(scratch, dtype=np.uint8, mode='r', shape=(offsets[-1],))
+        else:
+            seqs = np.zeros(0, dtype=np.uint8)
+
+        for ri in order:
+            yield keys[ri], np.array(seqs[offsets[ri]:offsets[ri+1]])
+    finally:
+        scratch.close()
+
+
+################################################################################
+# Encoded sequence cache
+#
+# Encoded sequences are cached on disk across runs in cache_dir, one entry
+# directory per set of input files, named by a hash of their content:
+#
+#  headers.npy, seq_lens.npy:  Record headers and lengths.
+#  codes_<seq_len>.npy:        Records x seq_len uint8 nucleotide codes,
+#                              read through a memory map.
+#
+# Entries are touched when used, and the least recently used are evicted
+# beyond a size cap.
+################################################################################
+cache_version = b'1'
+
+################################################################################
+# cache_entry
+#
+# Entry directory of input_files in cache_dir, created if missing and
+# marked as used.
+################################################################################
+def cache_entry(cache_dir, input_files):
+    key = hashlib.sha1(cache_version)
+    for input_file in input_files:
+        with open(input_file, 'rb') as input_in:
+            for data in iter(lambda: input_in.read(1 << 20), b''):
+                key.update(data)
+        key.update(b'\0')
+
+    entry = os.path.join(cache_dir, key.hexdigest())
+    if not os.path.isdir(entry):
+        os.makedirs(entry)
+    os.utime(entry, None)
+
+    return entry
+
+
+################################################################################
+# cached_lengths
+#
+# Headers and lengths of the records of fasta_file, from the cache entry or
+# else read by fasta_lengths and stored in it.
+################################################################################
+def cached_lengths(entry, fasta_file):
+    headers_file = os.path.join(entry, 'headers.npy')
+    lens_file = os.path.join(entry, 'seq_lens.npy')
+
+    if not os.path.isfile(lens_file):
+        headers, seq_lens = fasta_lengths(fasta_file)
+        cache_save(headers_file, np.array(headers, dtype='S'))
+        cache_save(lens_file, seq_lens)
+
+    return list(np.load(headers_file)), np.load(lens_file)
+
+
+################################################################################
+# cached_codes
+#
+# Nucleotide codes of all records, trimmed or padded to seq_len, from the
+# cache entry or else encoded from records and stored in it.
+#
+# Input
+#  entry:        Cache entry directory.
+#  records:      Iterator of (header, seq) over all records, only read if the
+#                codes are not cached.
+#  num_records:  Number of records.
+#  seq_len:      Sequence length.
+#  block_size:   Sequences per encoded block.
+#  workers:      Number of encoding processes.
+#
+# Output
+#  seq_codes:    num_records x seq_len uint8 memory map, row i for record i.
+################################################################################
+def cached_codes(entry, records, num_records, seq_len, block_size=4096, workers=1):
+    codes_file = os.path.join(entry, 'codes_%d.npy' % seq_len)
+
+    if not os.path.isfile(codes_file):
+        print(' Encoding into cache', file=sys.stderr)
+        codes_fd, codes_tmp = tempfile.mkstemp(suffix='.npy', dir=entry)
+        os.close(codes_fd)
+
+        try:
+            seq_codes = np.lib.format.open_memmap(codes_tmp, mode='w+', dtype=np.uint8, shape=(num_records,seq_len))
+            r0 = 0
+            for headers, block_codes in encode_blocks(records, seq_len, block_size, workers, codes=True):
+                seq_codes[r0:r0+len(headers)] = block_codes
+                r0 += len(headers)
+                run_stats.count(len(headers))
+            seq_codes.flush()
+            del seq_codes
+
+            if r0 != num_records:
+                raise ValueError('Cache expected %d records, read %d' % (num_records, r0))
+            os.chmod(codes_tmp, 0o644)
+            os.rename(codes_tmp, codes_file)
+        finally:
+            if os.path.exists(codes_tmp):
+                os.remove(codes_tmp)
+    else:
+        print(' Codes read from cache', file=sys.stderr)
+
+    return np.load(codes_file, mmap_mode='r')
+
+
+################################################################################
+# cache_save
+#
+# Save an array into the cache through a temporary file, so an interrupted
+# run never leaves a partial entry.
+################################################################################
+def cache_save(cache_file, data):
+    cache_fd, cache_tmp = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(cache_file))
+    with os.fdopen(cache_fd, 'wb') as cache_out:
+        np.save(cache_out, data)
+    os.chmod(cache_tmp, 0o644)
+    os.rename(cache_tmp, cache_file)
+
+
+################################################################################
+# evict_cache
+#
+# Remove the least recently used entries of cache_dir until it holds at most
+# max_bytes, sparing the entry in use.
+################################################################################
+def evict_cache(cache_dir, max_bytes, keep=None):
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if os.path.isdir(entry):
+            entry_bytes = sum(os.path.getsize(os.path.join(entry, entry_file)) for entry_file in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), entry, entry_bytes))
+
+    cache_bytes = sum(entry_bytes for mtime, entry, entry_bytes in entries)
+    for mtime, entry, entry_bytes in sorted(entries):
+        if cache_bytes <= max_bytes:
+            break
+        if keep is not None and os.path.abspath(entry) == os.path.abspath(keep):
+            continue
+        print(' Evicting cache entry %s (%d bytes)' % (entry, entry_bytes), file=sys.stderr)
+        for entry_file in os.listdir(entry):
+            os.remove(os.path.join(entry, entry_file))
+        os.rmdir(entry)
+        cache_bytes -= entry_bytes
+
+
+################################################################################
+# code_blocks
+#
+# Stack (key, codes) records, e.g. rows of cached_codes, into blocks as
+# encode_blocks would encode them, decoding to one hot unless codes.
+################################################################################
+def code_blocks(records, block_size, codes=False):
+    for keys, seqs_codes in record_blocks(records, block_size):
+        seqs_codes = np.stack(seqs_codes)
+        if codes:
+            yield keys, seqs_codes
+        else:
+            yield keys, decode_codes(seqs_codes)
+
+
+################################################################################
+# seq_bytes
+#
+# View a sequence as a uint8 array of ASCII codes without copying.
+################################################################################
+def seq_bytes(seq):
+    if isinstance(seq, np.ndarray):
+        return seq
+    if not isinstance(seq, bytes):
+        seq = seq.encode('ascii')
+    return np.frombuffer(seq, dtype=np.uint8)
+
+
+################################################################################
+# fasta2dict
+#
+# Read a multifasta file into a dict.  Taking the whole line as the key.
+################################################################################
+def fasta2dict(fasta_file):
+    return OrderedDict(read_fasta(fasta_file))
 
-    return seq_vec
-'''
 
-def dna_one_hot(seq, seq_len=None, flatten=True):
-    if seq_len == None:
-        seq_len = len(seq)
-        seq_start = 0
+################################################################################
+# fasta_open
+#
+# Open a FASTA file for binary line reading, decompressing if it ends in .gz.
+################################################################################
+def fasta_open(fasta_file):
+    if fasta_file.endswith('.gz'):
+        return gzip.open(fasta_file, 'rb')
     else:
-        if seq_len <= len(seq):
-            # trim the sequence
-            seq_trim = (len(seq)-seq_len) // 2
-            seq = seq[seq_trim:seq_trim+seq_len]
-            seq_start = 0
-        else:
-            seq_start = (seq_len-len(seq)) // 2
+        return open(fasta_file, 'rb')
 
-    seq = seq.upper()
 
-    seq = seq.replace('A','0')
-    seq = seq.replace('C','1')
-    seq = seq.replace('G','2')
-    seq = seq.replace('T','3')
+################################################################################
+# read_fasta
+#
+# Iterate over the records of a FASTA file in one pass, joining sequence lines
+# once per record rather than by repeated concatenation.
+#
+# Input
+#  fasta_file:  Input FASTA file.
+#
+# Output
+#  Generator of (header, seq) pairs, both bytes, the header without '>'.
+################################################################################
+def read_fasta(fasta_file):
+    header = None
+    seq_lines = []
+
+    with fasta_open(fasta_file) as fasta_in:
+        for line in fasta_in:
+            if line[:1] == b'>':
+                if header is not None:
+                    yield header, b''.join(seq_lines)
+                header = line[1:].rstrip()
+                seq_lines = []
+            else:
+                seq_lines.append(line.rstrip())
 
-    # map nt's to a matrix 4 x len(seq) of 0's and 1's.
-    #  dtype='int8' fails for N's
-    seq_code = np.zeros((4,seq_len), dtype='float16')
-    for i in range(seq_len):
-        if i < seq_start:
-            seq_code[:,i] = 0.25
-        # GEH 11/10/17
-        # ambiguity codes
-        # A C G T
-        # 0 1 2 3 
-        elif seq[i-seq_start] == "M":
-            seq_code[0,i] = 0.5
-            seq_code[1,i] = 0.5
-        elif seq[i-seq_start] == "R":
-            seq_code[0,i] = 0.5
-            seq_code[2,i] = 0.5
-        elif seq[i-seq_start] == "W":
-            seq_code[0,i] = 0.5
-            seq_code[3,i] = 0.5
-        elif seq[i-seq_start] == "S":
-            seq_code[1,i] = 0.5
-            seq_code[2,i] = 0.5
-        elif seq[i-seq_start] == "Y":
-            seq_code[1,i] = 0.5
-            seq_code[3,i] = 0.5
-        elif seq[i-seq_start] == "K":
-            seq_code[2,i] = 0.5
-            seq_code[3,i] = 0.5
-        else:
-            try:
-                seq_code[int(seq[i-seq_start]),i] = 1
-            except:
-                seq_code[:,i] = 0.25
+    if header is not None:
+        yield header, b''.join(seq_lines)
 
-    # flatten and make a column vector 1 x len(seq)
-    if flatten:
-        seq_vec = seq_code.flatten()[None,:]
 
-    return seq_vec
+################################################################################
+# fasta_lengths
+#
+# Read only the headers and sequence lengths of a FASTA file, without keeping
+# the sequences, e.g. to size output datasets before streaming.
+#
+# Input
+#  fasta_file:  Input FASTA file.
+#
+# Output
+#  headers:     List of FASTA headers.
+#  seq_lens:    Array of sequence lengths.
+################################################################################
+def fasta_lengths(fasta_file):
+    headers = []
+    seq_lens = []
 
+    for header, seq in read_fasta(fasta_file):
+        headers.append(header)
+        seq_lens.append(len(seq))
+        run_stats.count(1, len(seq))
 
+    return headers, np.array(seq_lens, dtype='int64')
 
 
 ################################################################################
-# fasta2dict
+# load_fasta
 #
-# Read a multifasta file into a dict.  Taking the whole line as the key.
+# Read all records of a FASTA file in a single pass.
+#
+# Input
+#  fasta_file:  Input FASTA file.
 #
-# I've found this can be quite slow for some reason, even for a single fasta
-# entry.
+# Output
+#  headers:     List of FASTA headers.
+#  seqs:        List of sequences.
+#  seq_lens:    Array of sequence lengths.
 ################################################################################
-def fasta2dict(fasta_file):
-    fasta_dict = OrderedDict()
-    header = ''
-
-    for line in gzip.open(fasta_file):
-        if line[0] == '>':
-            #header = line.split()[0][1:]
-            header = line[1:].rstrip()
-            fasta_dict[header] = ''
-        else:
-            fasta_dict[header] += line.rstrip()
+def load_fasta(fasta_file):
+    headers = []
+    seqs = []
+    seq_lens = []
 
-    return fasta_dict
+    for header, seq in read_fasta(fasta_file):
+        headers.append(header)
+        seqs.append(seq)
+        seq_lens.append(len(seq))
+        run_stats.count(1, len(seq))
+
+    return headers, seqs, np.array(seq_lens, dtype='int64')
 
 
 ################################################################################
@@ -244,55 +1217,81 @@ def fasta2dict(fasta_file):
 #
 # Output
 #  seq_scores:  Dict mapping FASTA headers to score vectors.
+#  seq_annot:   Dict mapping FASTA headers to annotation vectors.
 ################################################################################
 def hash_scores(scores_file):
+    headers, label_codes, labels, scores = read_scores(scores_file)
+
+    # GEH
+    # 11/10/2017
+    # parse data in melted format now
     seq_scores = {}
     seq_annot = {}
+    for i in range(len(headers)):
+        seq_scores[headers[i]] = scores[i:i+1]
+        seq_annot[headers[i]] = labels[label_codes[i:i+1]]
 
-    n_lines_processed = 0
-    for line in gzip.open(scores_file):
-        a = line.split()
+    return seq_scores, seq_annot
 
-        try:
-            # seq_scores[a[0]] = np.array([float(a[i]) for i in range(1,len(a))])
 
-            # GEH
-            # 11/10/2017
-            # parse data in melted format now
-            seq_scores[a[0]] = np.array([float(a[2])])
-            # seq_scores[a[0]] = np.array([float(a[i]) for i in range(1,1)])
-            # seq_annot[a[0]] = np.array([a[1], a[3]])
-            seq_annot[a[0]] = np.array([a[1]])
+################################################################################
+# read_scores
+#
+# Parse a gzipped melted scores file (header, label, score, ...) into
+# columns, reading chunk_size lines at a time with the pandas C tokenizer.
+# A first line whose score is not a number is skipped as a header.
+#
+# Input
+#  scores_file:  Melted scores file.
+#  chunk_size:   Lines parsed per chunk.
+#
+# Output
+#  headers:      Array of FASTA headers (bytes), one per line.
+#  label_codes:  int32 index of each line's label into labels.
+#  labels:       Array of distinct labels (bytes), in order of appearance.
+#  scores:       Scores, as int8 if all are integers within its range,
+#                else float64.
+################################################################################
+def read_scores(scores_file, chunk_size=1000000):
+    # skip a header line
+    with gzip.open(scores_file, 'rb') as scores_in:
+        first_line = scores_in.readline().split()
+    try:
+        float(first_line[2])
+        skip_rows = 0
+    except (IndexError, ValueError):
+        skip_rows = 1
+
+    reader = pd.read_csv(scores_file, compression='gzip', sep=r'\s+', header=None,
+                         usecols=[0,1,2], skiprows=skip_rows, dtype={0:str, 1:str, 2:np.float64},
+                         na_filter=False, chunksize=chunk_size)
 
-            n_lines_processed = n_lines_processed + 1
-            if n_lines_processed % 50000 == 0:
-                print(" scores processed:", n_lines_processed, end='\r')
-                sys.stdout.flush()
+    headers = []
+    label_codes = []
+    scores = []
+    label_index = OrderedDict()
 
-        except:
-            if n_lines_processed != 0:
-                print('Ignoring header line:', n_lines_processed, file=sys.stderr)
-
-    # consider converting the scores to integers
-    int_scores = True
-    for header in seq_scores:
-        if not np.equal(np.mod(seq_scores[header], 1), 0).all():
-            int_scores = False
-            break
+    for chunk in reader:
+        headers.append(chunk[0].values.astype('S'))
+        scores.append(chunk[2].values)
 
-    if int_scores:
-        for header in seq_scores:
-            seq_scores[header] = seq_scores[header].astype('int8')
+        # map this chunk's label codes onto the running label table
+        chunk_codes, chunk_labels = pd.factorize(chunk[1])
+        chunk_map = np.array([label_index.setdefault(label, len(label_index)) for label in chunk_labels], dtype='int32')
+        label_codes.append(chunk_map[chunk_codes])
 
-        '''
-        for header in seq_scores:
-            if seq_scores[header] > 0:
-                seq_scores[header] = np.array([0, 1], dtype=np.min_scalar_type(1))
-            else:
-                seq_scores[header] = np.array([1, 0], dtype=np.min_scalar_type(1))
-        '''
+        run_stats.count(len(chunk))
 
-    return seq_scores, seq_annot
+    headers = np.concatenate(headers) if headers else np.array([], dtype='S1')
+    label_codes = np.concatenate(label_codes) if label_codes else np.array([], dtype='int32')
+    scores = np.concatenate(scores) if scores else np.array([], dtype='float64')
+    labels = np.array(list(label_index.keys()), dtype='S')
+
+    # consider converting the scores to integers, if int8 holds them
+    if np.equal(np.mod(scores, 1), 0).all() and (len(scores) == 0 or (scores.min() >= -128 and scores.max() <= 127)):
+        scores = scores.astype('int8')
+
+    return headers, label_codes, labels, scores
 
 
 ################################################################################
@@ -306,59 +1305,24 @@ def hash_scores(scores_file):
 #  seq_vecs:    Dict mapping FASTA headers to sequence representation vectors.
 ################################################################################
 def hash_sequences_1hot(fasta_file, extend_len=None):
+    headers, seqs, seq_lens = load_fasta(fasta_file)
+
+    # empty records are skipped
+    keep = [i for i in range(len(seqs)) if seq_lens[i] > 0]
+
     # determine longest sequence
     if extend_len is not None:
         seq_len = extend_len
     else:
-        seq_len = 0
-        seq = ''
-        n_lines_processed = 0
-        for line in gzip.open(fasta_file):
-           
-            if line[0] == '>':
-                if seq:
-                    seq_len = max(seq_len, len(seq))
-
-                header = line[1:].rstrip()
-                seq = ''
-                # GEH 
-                # 11/10/2017
-                # add progress
-                n_lines_processed = n_lines_processed +1
-                if n_lines_processed % 50000 == 0:
-                    print(" fasta seq processed:", n_lines_processed, end='\r')
-                    sys.stdout.flush()
-            else:
-                seq += line.rstrip()
-        print(" fasta seq processed:", n_lines_processed, end='\n')       
+        seq_len = int(seq_lens.max()) if keep else 0
 
-        if seq:
-            seq_len = max(seq_len, len(seq))
+    # code sequences into one matrix; the dict holds row views of it
+    seqs_1hot = encode_batch([seqs[i] for i in keep], seq_len)
+    seqs_1hot = seqs_1hot.reshape((len(keep), -1))
 
-    # load and code sequences
     seq_vecs = OrderedDict()
-    seq = ''
-    n_lines_processed2 = 0
-    for line in gzip.open(fasta_file):
-        if line[0] == '>':
-            # GEH 
-            # 11/10/2017
-            # add progress
-            n_lines_processed2 = n_lines_processed2 +1
-            if n_lines_processed2 % 5000 == 0:
-                v = round( n_lines_processed2 / (n_lines_processed/100.0),2 )
-                print(" fasta seq recoded: ", v, "%       ", end='\r')
-                sys.stdout.flush()
-            if seq:
-                seq_vecs[header] = dna_one_hot(seq, seq_len)
-
-            header = line[1:].rstrip()
-            seq = ''
-        else:
-            seq += line.rstrip()
-    print(" fasta seq recoded: 100%       ", end='\n')
-    if seq:
-        seq_vecs[header] = dna_one_hot(seq, seq_len)
+    for k, i in enumerate(keep):
+        seq_vecs[headers[i]] = seqs_1hot[k:k+1]
 
     return seq_vecs
 
@@ -373,17 +1337,27 @@ def hash_sequences_1hot(fasta_file, extend_len=None):
 # Output
 #  train_seqs:    Matrix with sequence vector rows.
 #  train_scores:  Matrix with score vector rows.
+#  train_annot:   Matrix with annotation rows or, if annot_codes, int32
+#                 array of annotation codes; None if pivot, which gives
+#                 train_scores one column per label.
+#  train_headers: Array of FASTA headers, if return_headers.
+#  annot_labels:  Sorted annotation labels the codes index, if annot_codes.
+#  train_records: Array of FASTA record positions, if return_records.
 ################################################################################
-def load_data_1hot(fasta_file, scores_file, extend_len=None, mean_norm=True, whiten=False, permute=True, sort=False):
+def load_data_1hot(fasta_file, scores_file, extend_len=None, mean_norm=True, whiten=False, permute=True, sort=False, return_headers=False, workers=1, annot_codes=False, return_records=False, pivot=False, pivot_fill=0):
    
     # load sequences
-    seq_vecs = hash_sequences_1hot(fasta_file, extend_len)
+    with run_stats.stage('read_fasta'):
+        headers, seqs, seq_lens = load_fasta(fasta_file)
 
     # load scores
-    seq_scores, seq_annot = hash_scores(scores_file)
+    with run_stats.stage('read_scores'):
+        score_cols = read_scores(scores_file)
 
     # align and construct input matrix
-    train_seqs, train_scores, train_annot = align_seqs_scores_1hot(seq_vecs, seq_scores, seq_annot, sort)
+    with run_stats.stage('encode'):
+        train_seqs, train_scores, train_annot, train_headers, annot_labels, train_records = align_seqs_scores_batch(headers, seqs, seq_lens, score_cols, extend_len, sort, workers, pivot, pivot_fill)
+        run_stats.count(len(train_seqs), len(train_seqs) * (train_seqs.shape[1] // 4))
 
     # whiten scores
     if whiten:
@@ -396,9 +1370,24 @@ def load_data_1hot(fasta_file, scores_file, extend_len=None, mean_norm=True, whi
         order = npr.permutation(train_seqs.shape[0])
         train_seqs = train_seqs[order]
         train_scores = train_scores[order]
-        train_annot = train_annot[order]
+        if train_annot is not None:
+            train_annot = train_annot[order]
+        train_headers = train_headers[order]
+        train_records = train_records[order]
+
+    outputs = [train_seqs, train_scores]
+    if annot_codes or train_annot is None:
+        outputs.append(train_annot)
+    else:
+        outputs.append(annot_labels[train_annot][:,None])
+    if return_headers:
+        outputs.append(train_headers)
+    if annot_codes:
+        outputs.append(annot_labels)
+    if return_records:
+        outputs.append(train_records)
 
-    return train_seqs, train_scores, train_annot
+    return tuple(outputs)
 
 
 ################################################################################
@@ -413,10 +1402,12 @@ def load_data_1hot(fasta_file, scores_file, extend_len=None, mean_norm=True, whi
 ################################################################################
 def load_sequences(fasta_file, permute=False):
     # load sequences
-    seq_vecs = hash_sequences_1hot(fasta_file)
+    headers, seqs, seq_lens = load_fasta(fasta_file)
+    seqs = [seq for seq in seqs if seq]
+    seq_len = int(seq_lens.max())
 
-    # stack
-    train_seqs = np.vstack(seq_vecs.values())
+    # encode into one matrix
+    train_seqs = encode_batch(seqs, seq_len).reshape((len(seqs), -1))
 
     # randomly permute the data
     if permute:
@@ -437,42 +1428,12 @@ def load_sequences(fasta_file, permute=False):
 #  nt
 ################################################################################
 def one_hot_get(seq_vec, pos):
-    seq_len = len(seq_vec)/4
-
-    a0 = 0
-    c0 = seq_len
-    g0 = 2*seq_len
-    t0 = 3*seq_len
-
-    if seq_vec[a0+pos] == 1:
-        nt = 'A'
-    elif seq_vec[c0+pos] == 1:
-        nt = 'C'
-    elif seq_vec[g0+pos] == 1:
-        nt = 'G'
-    elif seq_vec[t0+pos] == 1:
-        nt = 'T'
-    # GEH 11/10/17
-    # ambiguity codes
-    # A C G T
-    # 0 1 2 3 
-    elif (seq_vec[a0+pos] == 0.5) and (seq_vec[c0+pos] == 0.5):
-        nt = 'M'
-    elif (seq_vec[a0+pos] == 0.5) and (seq_vec[g0+pos] == 0.5):
-        nt = 'R'
-    elif (seq_vec[a0+pos] == 0.5) and (seq_vec[t0+pos] == 0.5):
-        nt = 'W'
-    elif (seq_vec[c0+pos] == 0.5) and (seq_vec[g0+pos] == 0.5):
-        nt = 'S'
-    elif (seq_vec[c0+pos] == 0.5) and (seq_vec[t0+pos] == 0.5):
-        nt = 'Y'
-    elif (seq_vec[g0+pos] == 0.5) and (seq_vec[t0+pos] == 0.5):
-        nt = 'K'
+    seq_len = len(seq_vec)//4
 
-    else:
-        nt = 'N'
+    nt_vec = np.asarray(seq_vec)[pos::seq_len][:4]
+    nt_code = vec_key_codes[vec_keys(nt_vec.reshape((1,4,1)))[0,0]]
 
-    return nt
+    return code_nts[nt_code:nt_code+1].decode('ascii') if nt_code != bad_code else 'N'
 
 
 ################################################################################
@@ -487,54 +1448,7 @@ def one_hot_get(seq_vec, pos):
 # Output
 ################################################################################
 def one_hot_set(seq_vec, pos, nt):
-    # zero all
-    for ni in range(4):
-        seq_vec[ni,0,pos] = 0
-
-    # set the nt
-    if nt == 'A':
-        seq_vec[0,0,pos] = 1
-    elif nt == 'C':
-        seq_vec[1,0,pos] = 1
-    elif nt == 'G':
-        seq_vec[2,0,pos] = 1
-    elif nt == 'T':
-        seq_vec[3,0,pos] = 1
-
-    # GEH 11/10/17
-    # ambiguity codes
-    # A C G T
-    # 0 1 2 3 
-
-    elif nt == 'M':
-        seq_vec[0,0,pos] = 0.5
-        seq_vec[1,0,pos] = 0.5
-
-    elif nt == 'R':
-        seq_vec[0,0,pos] = 0.5
-        seq_vec[2,0,pos] = 0.5
-
-    elif nt == 'W':
-        seq_vec[0,0,pos] = 0.5
-        seq_vec[3,0,pos] = 0.5
-
-    elif nt == 'S':
-        seq_vec[1,0,pos] = 0.5
-        seq_vec[2,0,pos] = 0.5
-
-    elif nt == 'Y':
-        seq_vec[1,0,pos] = 0.5
-        seq_vec[3,0,pos] = 0.5
-
-    elif nt == 'K':
-        seq_vec[2,0,pos] = 0.5
-        seq_vec[3,0,pos] = 0.5
-
-    else:
-        for ni in range(4):
-            seq_vec[ni,0,pos] = 0.25
-
-
+    seq_vec[:,0,pos] = code_vecs[nt_codes[ord(nt)]]
 
 
 ################################################################################
@@ -548,66 +1462,283 @@ def one_hot_set(seq_vec, pos, nt):
 # Output
 ################################################################################
 def one_hot_set_1d(seq_vec, pos, nt):
-    seq_len = len(seq_vec)/4
-
-    a0 = 0
-    c0 = seq_len
-    g0 = 2*seq_len
-    t0 = 3*seq_len
-
-    # zero all
-    seq_vec[a0+pos] = 0
-    seq_vec[c0+pos] = 0
-    seq_vec[g0+pos] = 0
-    seq_vec[t0+pos] = 0
-
-    # set the nt
-    if nt == 'A':
-        seq_vec[a0+pos] = 1
-    elif nt == 'C':
-        seq_vec[c0+pos] = 1
-    elif nt == 'G':
-        seq_vec[g0+pos] = 1
-    elif nt == 'T':
-        seq_vec[t0+pos] = 1
-
-    # GEH 11/10/17
-    # ambiguity codes
-    # A C G T
-    # 0 1 2 3 
-
-    elif nt == 'M':
-        seq_vec[a0+pos] = 0.5
-        seq_vec[c0+pos] = 0.5
-
-    elif nt == 'R':
-        seq_vec[a0+pos] = 0.5
-        seq_vec[g0+pos] = 0.5
-
-    elif nt == 'W':
-        seq_vec[a0+pos] = 0.5
-        seq_vec[t0+pos] = 0.5
-
-    elif nt == 'S':
-        seq_vec[c0+pos] = 0.5
-        seq_vec[g0+pos] = 0.5
-
-    elif nt == 'Y':
-        seq_vec[c0+pos] = 0.5
-        seq_vec[t0+pos] = 0.5
-
-    elif nt == 'K':
-        seq_vec[g0+pos] = 0.5
-        seq_vec[t0+pos] = 0.5
+    seq_len = len(seq_vec)//4
+    seq_vec[pos + seq_len*np.arange(4)] = code_vecs[nt_codes[ord(nt)]]
+
+
+################################################################################
+# one_hot_set_batch
+#
+# Apply many single-position edits to a batch of one hot sequences with one
+# scatter, e.g. to set variant alleles.
+#
+# Input
+#  seq_vecs:  N x 4 x 1 x L sequences, or N x 4L flattened rows.
+#  seq_idx:   Sequence index of each edit.
+#  pos:       Position of each edit.
+#  nts:       Nucleotide of each edit, as nucleotide codes (integers) or
+#             IUPAC letters (a str/bytes with one letter per edit, or an
+#             array of single letters).
+#  copy:      Edit a copy rather than seq_vecs in place.
+#
+# Output
+#  seq_vecs:  The edited array. Of repeated (seq_idx, pos) pairs, the last
+#             edit wins.
+################################################################################
+def one_hot_set_batch(seq_vecs, seq_idx, pos, nts, copy=False):
+    if copy:
+        seq_vecs = seq_vecs.copy()
+
+    # N x 4 x L view; assigning the shape fails rather than copying
+    seq_mats = seq_vecs.view()
+    seq_mats.shape = (seq_vecs.shape[0], 4, -1)
+
+    seq_mats[np.asarray(seq_idx), :, np.asarray(pos)] = code_vecs[nt_code_array(nts)]
+
+    return seq_vecs
+
+
+################################################################################
+# mutagenesis_batches
+#
+# Generate every single-site mutant of one or more one hot sequences in fixed
+# size minibatches, for in silico saturation mutagenesis. Each minibatch is
+# gathered from the references and edited with one scatter, so memory stays
+# at one minibatch whatever the number of mutants.
+#
+# At an A/C/G/T position the mutants are the three other nucleotides, plus
+# with hets the three heterozygotes of the reference with another nucleotide.
+# At other positions (heterozygous, N or padding) they are all four
+# nucleotides, plus with hets every other heterozygous code.
+#
+# Input
+#  seq_vecs:    4 x 1 x L sequence or N x 4 x 1 x L sequences.
+#  batch_size:  Mutants per minibatch.
+#  hets:        Include heterozygous substitutions.
+#
+# Output
+#  Generator of (mut_vecs, seq_idx, pos, nts): a batch x 4 x 1 x L array of
+#  mutants, only valid until the next minibatch is read, and for each mutant
+#  its reference sequence index, position and nucleotide code.
+################################################################################
+def mutagenesis_batches(seq_vecs, batch_size=128, hets=False):
+    if seq_vecs.ndim == 3:
+        seq_vecs = seq_vecs[None]
+    seq_len = seq_vecs.shape[-1]
+
+    ref_codes = vecs2codes(seq_vecs)
+    alt_mask = mutation_mask(hets)
+    mut_vecs = np.empty((batch_size,) + seq_vecs.shape[1:], dtype=seq_vecs.dtype)
+
+    pending = [np.zeros(0, dtype='int64')] * 3
+    for si in range(seq_vecs.shape[0]):
+        seq_pos, seq_nts = np.nonzero(alt_mask[ref_codes[si]])
+        seq_idx = np.full(len(seq_pos), si, dtype='int64')
+        pending = [np.concatenate(pair) for pair in zip(pending, (seq_idx, seq_pos, seq_nts))]
+
+        while len(pending[0]) >= batch_size or (si == seq_vecs.shape[0]-1 and len(pending[0]) > 0):
+            batch_idx, batch_pos, batch_nts = [column[:batch_size] for column in pending]
+            pending = [column[batch_size:] for column in pending]
+
+            batch_vecs = mut_vecs[:len(batch_idx)]
+            np.take(seq_vecs, batch_idx, axis=0, out=batch_vecs)
+            one_hot_set_batch(batch_vecs, np.arange(len(batch_idx)), batch_pos, batch_nts)
+
+            yield batch_vecs, batch_idx, batch_pos, batch_nts
+
+
+################################################################################
+# mutation_mask
+#
+# 256 x 10 boolean table of the mutant codes (columns, A-K) for each
+# reference code (rows), as described in mutagenesis_batches.
+################################################################################
+def mutation_mask(hets=False):
+    alt_mask = np.zeros((256,n_code), dtype='bool')
+    alt_mask[:,:4] = True
+    if hets:
+        alt_mask[:,4:] = True
+
+    for ci, channels in enumerate(iupac_channels.values()):
+        alt_mask[ci,ci] = False
+        if ci < 4 and hets:
+            # only heterozygotes of the reference nucleotide
+            for hi, het_channels in enumerate(iupac_channels.values()):
+                if len(het_channels) == 2 and ci not in het_channels:
+                    alt_mask[ci,hi] = False
+
+    return alt_mask
+
+
+################################################################################
+# nt_code_array
+#
+# Nucleotide codes for nucleotides given as codes or IUPAC letters.
+################################################################################
+def nt_code_array(nts):
+    if isinstance(nts, (bytes, str)):
+        return nt_codes[seq_bytes(nts)]
+
+    nts = np.asarray(nts)
+    if nts.dtype.kind in 'SU':
+        return nt_codes[seq_bytes(b''.join(nts.astype('S1').ravel()))].reshape(nts.shape)
+    else:
+        return nts.astype('int64')
+
+
+################################################################################
+# read_seqs
+#
+# Read one hot sequences [r0, r1) of a split from an HDF5 file written by
+# seq_hdf5_v2 in any of its layouts: dense *_in (float16 or, with a
+# code_table, uint8 codes), --dedup or --sparse.
+#
+# Input
+#  h5f:     Open HDF5 file.
+#  prefix:  Split, e.g. train.
+#  r0, r1:  Row range.
+#  out:     Optional preallocated (r1-r0) x 4 x 1 x L array to fill.
+#
+# Output
+#  seqs_1hot: (r1-r0) x 4 x 1 x L float16 array (out, if given).
+################################################################################
+def read_seqs(h5f, prefix, r0, r1, out=None):
+    if '%s_index' % prefix in h5f:
+        return read_dedup(h5f, prefix, r0, r1, out)
+    elif '%s_window' % prefix in h5f:
+        return read_sparse(h5f, prefix, r0, r1, out)
+
+    seqs_in = h5f['%s_in' % prefix]
+    if seqs_in.dtype == np.uint8:
+        return decode_codes(seqs_in[r0:r1], out, table=h5f['code_table'][()])
+    elif out is None:
+        return seqs_in[r0:r1]
+    else:
+        seqs_in.read_direct(out, np.s_[r0:r1])
+        return out
+
+
+################################################################################
+# num_seqs
+#
+# Number of sequences in a split of an HDF5 file, in any layout.
+################################################################################
+def num_seqs(h5f, prefix):
+    if '%s_out_indptr' % prefix in h5f:
+        return h5f['%s_out_indptr' % prefix].shape[0] - 1
+    return h5f['%s_out' % prefix].shape[0]
+
+
+################################################################################
+# read_targets
+#
+# Read targets [r0, r1) of a split, densifying them if they are stored as
+# CSR (prefix_out_indptr, _indices, _data; see seq_hdf5_v2 --pivot_csr).
+################################################################################
+def read_targets(h5f, prefix, r0, r1):
+    if '%s_out' % prefix in h5f:
+        return h5f['%s_out' % prefix][r0:r1]
+
+    indptr_data = h5f['%s_out_indptr' % prefix]
+    indptr = indptr_data[r0:r1+1]
+    e0, e1 = indptr[0], indptr[-1]
+    indices = h5f['%s_out_indices' % prefix][e0:e1]
+    data = h5f['%s_out_data' % prefix][e0:e1]
+
+    num_cols = int(indptr_data.attrs['num_cols'])
+    fill = indptr_data.attrs['fill']
+    return csr_dense(indptr - e0, indices, data, np.arange(r1-r0), num_cols, fill, indptr_data.attrs['dtype'])
+
+
+################################################################################
+# read_sparse
+#
+# Rebuild dense one hot sequences [r0, r1) of a split stored in the sparse
+# layout of seq_hdf5_v2 --sparse: gather each sequence's window codes, then
+# scatter its differences in one assignment.
+#
+# Input
+#  h5f:     Open HDF5 file.
+#  prefix:  Split, e.g. train.
+#  r0, r1:  Row range.
+#  out:     Optional preallocated (r1-r0) x 4 x 1 x L array to fill.
+#
+# Output
+#  seqs_1hot: (r1-r0) x 4 x 1 x L float16 array (out, if given).
+################################################################################
+def read_sparse(h5f, prefix, r0, r1, out=None):
+    seq_windows = h5f['%s_window' % prefix][r0:r1]
+    diff_ptr = h5f['%s_diff_ptr' % prefix][r0:r1+1]
+    diff_pos = h5f['%s_diff_pos' % prefix][diff_ptr[0]:diff_ptr[-1]]
+    diff_codes = h5f['%s_diff_code' % prefix][diff_ptr[0]:diff_ptr[-1]]
+
+    # h5py reads increasing indexes, so read each window once
+    window_idx, seq_window_idx = np.unique(seq_windows, return_inverse=True)
+    seq_codes = h5f['windows'][window_idx][seq_window_idx.ravel()]
+
+    diff_rows = np.repeat(np.arange(r1-r0), np.diff(diff_ptr))
+    seq_codes[diff_rows, diff_pos] = diff_codes
+
+    return decode_codes(seq_codes, out, table=h5f['code_table'][()])
+
+
+################################################################################
+# read_dedup
+#
+# Expand sequences [r0, r1) of a split written by seq_hdf5_v2 --dedup through
+# its index into seqs_unique.
+#
+# Input
+#  h5f:     Open HDF5 file.
+#  prefix:  Split, e.g. train.
+#  r0, r1:  Row range.
+#  out:     Optional preallocated (r1-r0) x 4 x 1 x L array to fill.
+#
+# Output
+#  seqs_1hot: (r1-r0) x 4 x 1 x L float16 array (out, if given).
+################################################################################
+def read_dedup(h5f, prefix, r0, r1, out=None):
+    seq_index = h5f['%s_index' % prefix][r0:r1]
+
+    # h5py reads increasing indexes, so read each sequence once
+    unique_idx, seq_unique_idx = np.unique(seq_index, return_inverse=True)
+    seqs_unique = h5f['seqs_unique'][unique_idx]
 
+    if seqs_unique.dtype == np.uint8:
+        return decode_codes(seqs_unique[seq_unique_idx.ravel()], out, table=h5f['code_table'][()])
+    elif out is None:
+        return seqs_unique[seq_unique_idx.ravel()]
     else:
-        seq_vec[a0+pos] = 0.25
-        seq_vec[c0+pos] = 0.25
-        seq_vec[g0+pos] = 0.25
-        seq_vec[t0+pos] = 0.25
+        np.take(seqs_unique, seq_unique_idx.ravel(), axis=0, out=out)
+        return out
 
 
+################################################################################
+# vecs2codes
+#
+# Decode one hot sequences to nucleotide codes, all positions at once.
+#
+# Input
+#  seq_vecs:   N x 4L, N x 4 x L or N x 4 x 1 x L one hot sequences.
+#
+# Output
+#  seq_codes:  N x L uint8 codes; padding decodes as N and malformed
+#              positions as bad_code.
+################################################################################
+def vecs2codes(seq_vecs):
+    seq_vecs = np.reshape(seq_vecs, (seq_vecs.shape[0], 4, -1))
+    return vec_key_codes[vec_keys(seq_vecs)]
+
 
+################################################################################
+# codes2dna
+#
+# Nucleotide codes to a list of sequence strings, malformed positions as N.
+################################################################################
+def codes2dna(seq_codes):
+    nts = np.frombuffer(code_nts + b'N', dtype='uint8')
+    seq_nts = nts[np.minimum(seq_codes, len(code_nts))]
+    return [row.tobytes().decode('ascii') for row in seq_nts]
 
 
 def vecs2dna(seq_vecs):
@@ -619,54 +1750,259 @@ def vecs2dna(seq_vecs):
         seqs
     '''
 
-    # possibly reshape
-    if len(seq_vecs.shape) == 2:
-        seq_vecs = np.reshape(seq_vecs, (seq_vecs.shape[0], 4, -1))
-    elif len(seq_vecs.shape) == 4:
-        seq_vecs = np.reshape(seq_vecs, (seq_vecs.shape[0], 4, -1))
+    seq_codes = vecs2codes(seq_vecs)
+
+    for i, j in zip(*np.nonzero(seq_codes == bad_code)):
+        seq_vec = np.reshape(seq_vecs[i], (4, -1))[:,j]
+        print('Malformed position vector: ', seq_vec, 'for sequence %d position %d' % (i,j), file=sys.stderr)
+
+    return codes2dna(seq_codes)
+
+################################################################################
+# het_nts
+#
+# 256 x 256 table of the IUPAC byte for a heterozygote of two nucleotides,
+# N where the pair has no two-nucleotide code.
+################################################################################
+def make_het_nts():
+    het_nts = np.full((256,256), ord('N'), dtype='uint8')
+    for nt, channels in iupac_channels.items():
+        if len(channels) == 2:
+            nt1, nt2 = [b'ACGT'[ci:ci+1] for ci in channels]
+            for a1 in [nt1, nt1.lower()]:
+                for a2 in [nt2, nt2.lower()]:
+                    het_nts[ord(a1),ord(a2)] = ord(nt)
+                    het_nts[ord(a2),ord(a1)] = ord(nt)
+    for ci in range(4):
+        nt = b'ACGT'[ci:ci+1]
+        het_nts[ord(nt),ord(nt)] = ord(nt)
+    return het_nts
+
+het_nts = make_het_nts()
+
+
+################################################################################
+# index_fasta
+#
+# Read the samtools .fai index of an uncompressed FASTA file, writing it
+# first if it does not exist.
+#
+# Output
+#  fai:  Dict mapping sequence names to (length, offset, line bases,
+#        line bytes).
+################################################################################
+def index_fasta(fasta_file):
+    fai_file = fasta_file + '.fai'
+
+    if not os.path.isfile(fai_file):
+        if fasta_file.endswith('.gz'):
+            raise ValueError('Reference FASTA %s must be uncompressed for random access' % fasta_file)
+
+        with open(fasta_file, 'rb') as fasta_in, open(fai_file, 'w') as fai_out:
+            name = None
+            offset = 0
+            for line in fasta_in:
+                if line[:1] == b'>':
+                    if name is not None:
+                        print('%s\t%d\t%d\t%d\t%d' % (name, seq_len, seq_offset, line_bases, line_bytes), file=fai_out)
+                    name = line[1:].split()[0].decode('ascii')
+                    seq_len = 0
+                    seq_offset = offset + len(line)
+                    line_bases = line_bytes = 0
+                elif line_bases == 0:
+                    line_bases = len(line.rstrip())
+                    line_bytes = len(line)
+                    seq_len += line_bases
+                else:
+                    seq_len += len(line.rstrip())
+                offset += len(line)
+            if name is not None:
+                print('%s\t%d\t%d\t%d\t%d' % (name, seq_len, seq_offset, line_bases, line_bytes), file=fai_out)
+
+    fai = OrderedDict()
+    for line in open(fai_file):
+        a = line.split()
+        fai[a[0]] = tuple(int(x) for x in a[1:5])
+
+    return fai
+
+
+################################################################################
+# fetch_fasta
+#
+# Read [start, end) of a sequence by random access through its .fai entry.
+#
+# Input
+#  fasta_in:  FASTA file opened in binary mode.
+#  fai:       Index from index_fasta.
+#  chrom:     Sequence name.
+#  start:     0-based start.
+#  end:       End, clipped to the sequence length.
+################################################################################
+def fetch_fasta(fasta_in, fai, chrom, start, end):
+    seq_len, offset, line_bases, line_bytes = fai[chrom]
+    end = min(end, seq_len)
+    if end <= start:
+        return b''
+
+    first = offset + (start // line_bases)*line_bytes + start % line_bases
+    last = offset + ((end-1) // line_bases)*line_bytes + (end-1) % line_bases
+
+    fasta_in.seek(first)
+    return fasta_in.read(last-first+1).replace(b'\n', b'').replace(b'\r', b'')
+
+
+################################################################################
+# read_bed
+#
+# Read BED regions as (chrom, start, end, name), naming unnamed regions
+# chrom:start-end.
+################################################################################
+def read_bed(bed_file):
+    regions = []
+    for line in fasta_open(bed_file):
+        a = line.split()
+        if not a or a[0][:1] == b'#' or a[0] in (b'track', b'browser'):
+            continue
+        chrom, start, end = a[0].decode('ascii'), int(a[1]), int(a[2])
+        if len(a) > 3:
+            name = a[3].decode('ascii')
+        else:
+            name = '%s:%d-%d' % (chrom, start, end)
+        regions.append((chrom, start, end, name))
+    return regions
+
+
+################################################################################
+# read_vcf
+#
+# Load the genotypes of biallelic SNVs from a VCF file; other variants are
+# skipped and counted.
+#
+# Input
+#  vcf_file:  VCF file, optionally gzipped.
+#  chroms:    Only keep variants on these chromosomes, if given.
+#
+# Output
+#  samples:   List of sample names.
+#  variants:  Dict mapping chromosomes to (pos, ref, alt, dosage): sorted
+#             0-based positions, REF and ALT bytes as uint8 and a variants x
+#             samples uint8 matrix of ALT allele counts (missing as 0).
+################################################################################
+def read_vcf(vcf_file, chroms=None):
+    samples = []
+    chrom_vars = OrderedDict()
+    num_skipped = 0
+
+    for line in fasta_open(vcf_file):
+        if line[:2] == b'##':
+            continue
+        a = line.rstrip(b'\r\n').split(b'\t')
+        if line[:1] == b'#':
+            samples = [sample.decode('ascii') for sample in a[9:]]
+            continue
+
+        chrom = a[0].decode('ascii')
+        if chroms is not None and chrom not in chroms:
+            continue
+        if len(a[3]) != 1 or len(a[4]) != 1 or a[4] in b'.*':
+            num_skipped += 1
+            continue
+
+        gt_i = a[8].split(b':').index(b'GT')
+        if gt_i == 0:
+            gts = [field[:3] for field in a[9:]]
+        else:
+            gts = [field.split(b':')[gt_i] for field in a[9:]]
+
+        # allele characters; a haploid call counts twice
+        gt_chars = np.array(gts, dtype='S3').view('uint8').reshape((len(gts),3))
+        allele1 = gt_chars[:,0] == ord('1')
+        haploid = (gt_chars[:,1] != ord('/')) & (gt_chars[:,1] != ord('|'))
+        allele2 = np.where(haploid, allele1, gt_chars[:,2] == ord('1'))
+
+        vars_list = chrom_vars.setdefault(chrom, ([], [], [], []))
+        vars_list[0].append(int(a[1]) - 1)
+        vars_list[1].append(ord(a[3]))
+        vars_list[2].append(ord(a[4]))
+        vars_list[3].append((allele1.astype('uint8') + allele2))
+
+    if num_skipped > 0:
+        print('Skipped %d VCF records that are not biallelic SNVs' % num_skipped, file=sys.stderr)
+
+    variants = OrderedDict()
+    for chrom, (pos, ref, alt, dosage) in chrom_vars.items():
+        pos = np.array(pos, dtype='int64')
+        order = np.argsort(pos, kind='mergesort')
+        variants[chrom] = (pos[order], np.array(ref, dtype='uint8')[order], np.array(alt, dtype='uint8')[order], np.vstack(dosage)[order])
+
+    return samples, variants
+
+
+################################################################################
+# variant_headers
+#
+# Headers and lengths of the sequences made by variant_records, one per
+# region and sample, region by region: <region name>_<sample>.
+################################################################################
+def variant_headers(regions, samples, fai):
+    headers = []
+    seq_lens = []
+    for chrom, start, end, name in regions:
+        region_len = max(0, min(end, fai[chrom][0]) - start)
+        for sample in samples:
+            headers.append(('%s_%s' % (name, sample)).encode('ascii'))
+            seq_lens.append(region_len)
+    return headers, np.array(seq_lens, dtype='int64')
+
+
+################################################################################
+# variant_records
+#
+# Sequences of every sample over every region, fetched from the reference by
+# random access with the sample's genotypes applied: heterozygous SNVs as
+# the IUPAC code of REF and ALT, homozygous ALT as ALT. The edits for all
+# samples of a region are applied with one scatter.
+#
+# Input
+#  ref_fasta:  Uncompressed reference FASTA, see index_fasta.
+#  regions:    Regions from read_bed.
+#  samples:    Samples, variants: from read_vcf.
+#
+# Output
+#  Generator of (header, seq) pairs, in the order of variant_headers.
+################################################################################
+def variant_records(ref_fasta, regions, samples, variants):
+    fai = index_fasta(ref_fasta)
+    num_ref_mismatch = 0
+
+    with open(ref_fasta, 'rb') as fasta_in:
+        for chrom, start, end, name in regions:
+            ref_seq = fetch_fasta(fasta_in, fai, chrom, start, end)
+            region_nts = np.tile(seq_bytes(ref_seq), (len(samples),1))
+
+            if chrom in variants:
+                pos, ref, alt, dosage = variants[chrom]
+                v0, v1 = np.searchsorted(pos, [start, start+len(ref_seq)])
+                var_pos = pos[v0:v1] - start
+
+                # reference check, case insensitive
+                num_ref_mismatch += (nt_codes[region_nts[0,var_pos]] != nt_codes[ref[v0:v1]]).sum() if len(samples) else 0
+
+                het_vars = het_nts[ref[v0:v1], alt[v0:v1]]
+                var_dosage = dosage[v0:v1].T
+
+                si, vi = np.nonzero(var_dosage == 1)
+                region_nts[si, var_pos[vi]] = het_vars[vi]
+                si, vi = np.nonzero(var_dosage == 2)
+                region_nts[si, var_pos[vi]] = alt[v0:v1][vi]
+
+            for si, sample in enumerate(samples):
+                yield ('%s_%s' % (name, sample)).encode('ascii'), region_nts[si]
+
+    if num_ref_mismatch > 0:
+        print('%d variant sites do not match the reference REF allele' % num_ref_mismatch, file=sys.stderr)
 
-    seqs = []
-    for i in range(seq_vecs.shape[0]):
-        seq_list = ['']*seq_vecs.shape[2]
-        for j in range(seq_vecs.shape[2]):
-            if seq_vecs[i,0,j] == 1:
-                seq_list[j] = 'A'
-            elif seq_vecs[i,1,j] == 1:
-                seq_list[j] = 'C'
-            elif seq_vecs[i,2,j] == 1:
-                seq_list[j] = 'G'
-            elif seq_vecs[i,3,j] == 1:
-                seq_list[j] = 'T'
-
-            # GEH 11/10/17
-            # ambiguity codes
-            # A C G T
-            # 0 1 2 3 
-            elif (seq_vecs[i,0,j] == 0.5) and (seq_vecs[i,1,j] == 0.5):
-                # M = A / C                  
-                seq_list[j] = 'M'
-            elif (seq_vecs[i,0,j] == 0.5) and (seq_vecs[i,2,j] == 0.5):
-                # R = A / G                  
-                seq_list[j] = 'R'
-            elif (seq_vecs[i,0,j] == 0.5) and (seq_vecs[i,3,j] == 0.5): 
-                # W = A / T                
-                seq_list[j] = 'W'
-            elif (seq_vecs[i,1,j] == 0.5) and (seq_vecs[i,2,j] == 0.5): 
-                # S = C / G                 
-                seq_list[j] = 'S'
-            elif (seq_vecs[i,1,j] == 0.5) and (seq_vecs[i,3,j] == 0.5): 
-                # Y = C / T              
-                seq_list[j] = 'Y'
-            elif (seq_vecs[i,2,j] == 0.5) and (seq_vecs[i,3,j] == 0.5): 
-                # K = G / T         
-                seq_list[j] = 'K'
-
-            elif seq_vecs[i,:,j].sum() == 1:
-                seq_list[j] = 'N'
-            else:
-                print('Malformed position vector: ', seq_vecs[i,:,j], 'for sequence %d position %d' % (i,j), file=sys.stderr)
-        seqs.append(''.join(seq_list))
-    return seqs
 
 # IUPAC Ambiguity Codes
 # There are cdoes for 3 nucleotides, but let's igmore those 
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+from __future__ import print_function
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from optparse import OptionParser
+import sys
+import time
+
+import h5py
+import numpy as np
+
+import dna_io_v2 as dna_io
+
+################################################################################
+# hdf5_batches_v2.py
+#
+# Serve shuffled minibatches from an HDF5 file made by seq_hdf5_v2.py.
+#
+# Rows are read in contiguous chunks, aligned with the dataset's HDF5
+# chunks, in shuffled chunk order. A shuffle buffer of several chunks is
+# then permuted row by row, so minibatches mix rows from distant parts of
+# the file while every read stays sequential. Buffers are read and decoded
+# ahead on a thread pool. Dense, uncompressed float16 *_in datasets are read
+# through a memory map, and CSR targets (--pivot_csr) are densified per
+# buffer.
+################################################################################
+
+################################################################################
+# hdf5_batches
+#
+# Input
+#  h5_file:        HDF5 file.
+#  split:          Dataset prefix, e.g. train.
+#  batch_size:     Rows per minibatch.
+#  shuffle:        Shuffle chunks and rows; otherwise serve rows in order.
+#  seed:           Seed of the shuffle; epoch e uses seed + e.
+#  epochs:         Passes over the data.
+#  buffer_chunks:  Chunks per shuffle buffer.
+#  chunk_rows:     Rows per chunk [Default: the HDF5 chunk rows, or 1024].
+#  threads:        Threads reading and decoding buffers.
+#  prefetch:       Buffers read ahead of the consumer.
+#  drop_last:      Drop the final incomplete minibatch of each epoch.
+#
+# Output
+#  Generator of (seqs_1hot, targets, add) minibatches; add is None without
+#  a *_add dataset.
+################################################################################
+def hdf5_batches(h5_file, split='train', batch_size=128, shuffle=True, seed=1, epochs=1, buffer_chunks=16, chunk_rows=None, threads=2, prefetch=4, drop_last=False):
+    h5f = h5py.File(h5_file, 'r')
+    num_rows = dna_io.num_seqs(h5f, split)
+
+    if chunk_rows is None:
+        chunk_rows = default_chunk_rows(h5f, split)
+
+    seqs_mmap = memmap_in(h5_file, h5f, split)
+    add = h5f['%s_add' % split] if '%s_add' % split in h5f else None
+
+    pool = ThreadPool(threads)
+    try:
+        for epoch in range(epochs):
+            rng = np.random.RandomState(seed + epoch)
+
+            chunks = [(r0, min(num_rows, r0+chunk_rows)) for r0 in range(0, num_rows, chunk_rows)]
+            if shuffle:
+                chunks = [chunks[ci] for ci in rng.permutation(len(chunks))]
+            buffers = [chunks[bi:bi+buffer_chunks] for bi in range(0, len(chunks), buffer_chunks)]
+            buffer_seeds = rng.randint(0, 2**31-1, size=len(buffers))
+
+            pending = deque()
+            carry = None
+            for bi in range(len(buffers) + prefetch):
+                if bi < len(buffers):
+                    buffer_rng = np.random.RandomState(buffer_seeds[bi]) if shuffle else None
+                    pending.append(pool.apply_async(read_buffer, (h5f, split, seqs_mmap, add, buffers[bi], buffer_rng)))
+                if len(pending) > prefetch or (bi >= len(buffers) and pending):
+                    buffer = pending.popleft().get()
+                    if carry is not None:
+                        buffer = [np.concatenate(pair) if pair[0] is not None else None for pair in zip(carry, buffer)]
+
+                    num_full = len(buffer[0]) // batch_size * batch_size
+                    for b0 in range(0, num_full, batch_size):
+                        yield tuple(data[b0:b0+batch_size] if data is not None else None for data in buffer)
+                    carry = [data[num_full:] if data is not None else None for data in buffer]
+
+            if carry is not None and len(carry[0]) > 0 and not drop_last:
+                yield tuple(carry)
+    finally:
+        pool.terminate()
+        h5f.close()
+
+
+################################################################################
+# read_buffer
+#
+# Read and decode the chunks of one shuffle buffer, permuting its rows if
+# given a random state.
+################################################################################
+def read_buffer(h5f, split, seqs_mmap, add, chunks, rng):
+    seqs_1hot, buffer_targets, buffer_add = [], [], []
+    for r0, r1 in chunks:
+        if seqs_mmap is not None:
+            seqs_1hot.append(np.array(seqs_mmap[r0:r1]))
+        else:
+            seqs_1hot.append(dna_io.read_seqs(h5f, split, r0, r1))
+        buffer_targets.append(dna_io.read_targets(h5f, split, r0, r1))
+        if add is not None:
+            buffer_add.append(add[r0:r1])
+
+    seqs_1hot = np.concatenate(seqs_1hot)
+    buffer_targets = np.concatenate(buffer_targets)
+    buffer_add = np.concatenate(buffer_add) if add is not None else None
+
+    if rng is not None:
+        order = rng.permutation(len(seqs_1hot))
+        seqs_1hot = seqs_1hot[order]
+        buffer_targets = buffer_targets[order]
+        if buffer_add is not None:
+            buffer_add = buffer_add[order]
+
+    return [seqs_1hot, buffer_targets, buffer_add]
+
+
+################################################################################
+# default_chunk_rows
+#
+# Rows per read chunk: the HDF5 chunk rows of the sequence dataset, if it is
+# chunked, else 1024.
+################################################################################
+def default_chunk_rows(h5f, split):
+    for suffix in ['in', 'index', 'window']:
+        name = '%s_%s' % (split, suffix)
+        if name in h5f and h5f[name].chunks is not None:
+            return h5f[name].chunks[0]
+    return 1024
+
+
+################################################################################
+# memmap_in
+#
+# Memory map a contiguous, uncompressed float16 *_in dataset, or None.
+################################################################################
+def memmap_in(h5_file, h5f, split):
+    name = '%s_in' % split
+    if name not in h5f:
+        return None
+
+    seqs_in = h5f[name]
+    offset = seqs_in.id.get_offset()
+    if seqs_in.chunks is not None or seqs_in.dtype != np.float16 or offset is None:
+        return None
+
+    return np.memmap(h5_file, dtype=seqs_in.dtype, mode='r', offset=offset, shape=seqs_in.shape)
+
+
+################################################################################
+# main
+#
+# Time a pass over a split, e.g. to compare the layouts of seq_hdf5_v2.py.
+################################################################################
+def main():
+    usage = 'usage: %prog [options] <hdf5_file>'
+    parser = OptionParser(usage)
+    parser.add_option('-b', dest='batch_size', default=128, type='int', help='Minibatch size [Default: %default]')
+    parser.add_option('-d', dest='split', default='train', help='Split to read [Default: %default]')
+    parser.add_option('-t', dest='threads', default=2, type='int', help='Reader threads [Default: %default]')
+    (options,args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error('Must provide HDF5 file')
+
+    t0 = time.time()
+    num_rows = 0
+    for seqs_1hot, targets, add in hdf5_batches(args[0], options.split, options.batch_size, threads=options.threads):
+        num_rows += len(seqs_1hot)
+    elapsed = time.time() - t0
+
+    print('%d sequences in %.2f s, %.0f sequences/s' % (num_rows, elapsed, num_rows/max(elapsed, 1e-9)), file=sys.stderr)
+
+################################################################################
+# __main__
+################################################################################
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import contextlib
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+################################################################################
+# run_stats_v2.py
+#
+# Lightweight instrumentation of a pipeline run: named stages are timed,
+# count the records and bases they process, and track the peak resident
+# memory sampled by a background thread. A run ends with a JSON report and
+# can log the progress of the current stage at a set interval.
+#
+# Stages and counts are no-ops unless a run was started, so library code can
+# mark them unconditionally.
+################################################################################
+
+# state of the active run, or None
+run = None
+
+################################################################################
+# start_run
+#
+# Input
+#  log_interval:     Print a progress line for the current stage to stderr
+#                    every this many seconds; None for no log.
+#  sample_interval:  Seconds between resident memory samples.
+################################################################################
+def start_run(log_interval=None, sample_interval=0.1):
+    global run
+
+    run = {
+        'argv': list(sys.argv),
+        'start': time.time(),
+        'stages': [],
+        'stack': [],
+        'peak_rss': current_rss(),
+        'log_interval': log_interval,
+        'last_log': time.time(),
+        'stop': threading.Event()
+    }
+
+    sampler = threading.Thread(target=sample_rss, args=(run, sample_interval))
+    sampler.daemon = True
+    sampler.start()
+    run['sampler'] = sampler
+
+
+################################################################################
+# end_run
+#
+# Stop the run and write its report, if given a file.
+#
+# Output
+#  report:  Dict with the run's total time and peak memory and, per stage in
+#           order of entry, its time, records, bases, rates and peak memory.
+################################################################################
+def end_run(report_file=None):
+    global run
+    if run is None:
+        return None
+
+    run['stop'].set()
+    run['sampler'].join()
+    update_peaks(run)
+
+    seconds = time.time() - run['start']
+    report = {
+        'argv': run['argv'],
+        'start': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(run['start'])),
+        'seconds': seconds,
+        'peak_rss_mb': run['peak_rss'] / 2.0**20,
+        'children_peak_rss_mb': maxrss_bytes(resource.RUSAGE_CHILDREN) / 2.0**20,
+        'stages': [stage_report(stage_stats) for stage_stats in run['stages']]
+    }
+    run = None
+
+    if report_file is not None:
+        with open(report_file, 'w') as report_out:
+            json.dump(report, report_out, indent=2)
+
+    return report
+
+
+################################################################################
+# stage
+#
+# Context manager timing a named stage. Stages nest, a nested stage being
+# named outer/inner.
+################################################################################
+@contextlib.contextmanager
+def stage(name):
+    if run is None:
+        yield
+        return
+
+    if run['stack']:
+        name = '%s/%s' % (run['stack'][-1]['name'], name)
+
+    rss = current_rss()
+    stage_stats = {'name': name, 'start': time.time(), 'end': None, 'records': 0, 'bases': 0, 'rss_start': rss, 'rss_end': None, 'peak_rss': rss}
+    run['stages'].append(stage_stats)
+    run['stack'].append(stage_stats)
+    try:
+        yield
+    finally:
+        update_peaks(run)
+        stage_stats['end'] = time.time()
+        stage_stats['rss_end'] = current_rss()
+        run['stack'].remove(stage_stats)
+
+
+################################################################################
+# count
+#
+# Count records and bases processed by the current stage.
+################################################################################
+def count(records, bases=0):
+    if run is not None and run['stack']:
+        stage_stats = run['stack'][-1]
+        stage_stats['records'] += records
+        stage_stats['bases'] += bases
+
+
+################################################################################
+# stage_report
+#
+# Report entry of a finished stage.
+################################################################################
+def stage_report(stage_stats):
+    seconds = (stage_stats['end'] or time.time()) - stage_stats['start']
+    return {
+        'stage': stage_stats['name'],
+        'seconds': seconds,
+        'records': stage_stats['records'],
+        'bases': stage_stats['bases'],
+        'records_per_s': stage_stats['records'] / seconds if seconds > 0 else None,
+        'bases_per_s': stage_stats['bases'] / seconds if seconds > 0 else None,
+        'rss_start_mb': stage_stats['rss_start'] / 2.0**20,
+        'rss_end_mb': (stage_stats['rss_end'] or 0) / 2.0**20,
+        'peak_rss_mb': stage_stats['peak_rss'] / 2.0**20
+    }
+
+
+################################################################################
+# sample_rss
+#
+# Sampler thread: update the peak memory of the run and its open stages, and
+# log the current stage every log_interval seconds.
+################################################################################
+def sample_rss(run_state, sample_interval):
+    while not run_state['stop'].wait(sample_interval):
+        update_peaks(run_state)
+
+        log_interval = run_state['log_interval']
+        now = time.time()
+        if log_interval is not None and now - run_state['last_log'] >= log_interval and run_state['stack']:
+            run_state['last_log'] = now
+            stage_stats = run_state['stack'][-1]
+            seconds = now - stage_stats['start']
+            print('[%8.1fs] %s: %.1fs, %d records (%.0f/s), %d bases (%.0f/s), %.1f MB peak RSS' % (now - run_state['start'], stage_stats['name'], seconds, stage_stats['records'], stage_stats['records']/max(seconds, 1e-9), stage_stats['bases'], stage_stats['bases']/max(seconds, 1e-9), run_state['peak_rss']/2.0**20), file=sys.stderr)
+
+
+################################################################################
+# update_peaks
+################################################################################
+def update_peaks(run_state):
+    rss = current_rss()
+    run_state['peak_rss'] = max(run_state['peak_rss'], rss)
+    for stage_stats in list(run_state['stack']):
+        stage_stats['peak_rss'] = max(stage_stats['peak_rss'], rss)
+
+
+################################################################################
+# current_rss
+#
+# Resident memory of this process in bytes, from /proc where available, else
+# the peak so far.
+################################################################################
+def current_rss():
+    try:
+        with open('/proc/self/statm') as statm_in:
+            return int(statm_in.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return maxrss_bytes(resource.RUSAGE_SELF)
+
+
+################################################################################
+# maxrss_bytes
+#
+# Peak resident memory from getrusage, which reports kB except on macOS.
+################################################################################
+def maxrss_bytes(who):
+    maxrss = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss
+    return maxrss * 1024
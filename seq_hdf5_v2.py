@@ -1,16 +1,21 @@
 #!/usr/bin/env python
 from __future__ import print_function
 from optparse import OptionParser
+import os
 import sys
+import array
+import hashlib
+import tempfile
+import time
 
 import h5py
 import numpy.random as npr
 import numpy as np
 import pandas as pd
-import gzip
 import pdb
 
 import dna_io_v2 as dna_io
+import run_stats_v2 as run_stats
 
 ################################################################################
 # seq_hdf5.py
@@ -34,6 +39,30 @@ def main():
     parser.add_option('-t', dest='test_pct', default=0, type='float', help='Test % [Default: %default]')
     parser.add_option('-v', dest='valid_pct', default=0, type='float', help='Validation % [Default: %default]')
     parser.add_option('--vt', dest='valid_test', default=False, action='store_true', help='Use validation as test, too [Default: %default]')
+    parser.add_option('--stream', dest='stream', default=False, action='store_true', help='Encode and write sequences in blocks instead of loading the whole data set into memory [Default: %default]')
+    parser.add_option('--block', dest='block_size', default=4096, type='int', help='Sequences per block written when streaming [Default: %default]')
+    parser.add_option('--codes', dest='codes', default=False, action='store_true', help='Store sequences as N x L uint8 nucleotide codes plus a code_table to decode them; implies --stream [Default: %default]')
+    parser.add_option('--workers', dest='workers', default=1, type='int', help='Processes encoding sequences in parallel [Default: %default]')
+    parser.add_option('--chunk', dest='chunk_rows', default=None, type='int', help='Rows per HDF5 chunk of the *_in/*_out/*_add datasets [Default: batch size if -b, else when streaming the --block size capped at about 1 MB per chunk, else contiguous]')
+    parser.add_option('--compress', dest='compression', default=None, help='HDF5 compression filter for the chunked datasets: gzip or lzf [Default: %default]')
+    parser.add_option('--compress_level', dest='compression_level', default=None, type='int', help='gzip compression level 0-9 [Default: %default]')
+    parser.add_option('--shuffle', dest='shuffle', default=False, action='store_true', help='Apply the HDF5 byte shuffle filter before compressing [Default: %default]')
+    parser.add_option('--sparse', dest='sparse', default=False, action='store_true', help='Store each distinct window once as nucleotide codes plus, per sequence, its window and sparse (position, code) differences; implies --stream [Default: %default]')
+    parser.add_option('--sparse_sep', dest='sparse_sep', default='_', help='Separator of <region><sep><sample> headers: with --sparse on a FASTA, sequences of a region share a window, and --hash_group keys on either part [Default: %default]')
+    parser.add_option('--dedup', dest='dedup', default=False, action='store_true', help='Encode identical sequences once: store the distinct sequences in seqs_unique and per split an index into them (*_index) instead of *_in; implies --stream [Default: %default]')
+    parser.add_option('--hash_split', dest='hash_split', default=False, action='store_true', help='Assign each sequence to train/valid/test (-v, -t fractions) by a hash of its header, or --hash_group key, seeded by -s, so assignments are stable across rebuilds; implies --stream [Default: %default]')
+    parser.add_option('--hash_group', dest='hash_group', default='header', type='choice', choices=['header','region','sample'], help='Key hashed by --hash_split: the whole header, or its region or sample part (see --sparse_sep) to keep a region or individual in one split [Default: %default]')
+    parser.add_option('--vcf', dest='vcf_file', default=None, help='Build sequences from the reference <fasta_file> (uncompressed, random access through its .fai), the --bed regions and this VCF of genotypes, one per region and sample named <region>_<sample>; implies --stream [Default: %default]')
+    parser.add_option('--bed', dest='bed_file', default=None, help='BED regions for --vcf [Default: %default]')
+    parser.add_option('--pivot', dest='pivot', default=False, action='store_true', help='Pivot the melted targets into one *_out column per label, aligned to target_labels; without it, sequences with score lines of several labels are an error [Default: %default]')
+    parser.add_option('--pivot_fill', dest='pivot_fill', default=0, type='float', help='Target value of (sequence, label) pairs without a score line with --pivot, e.g. nan [Default: %default]')
+    parser.add_option('--pivot_csr', dest='pivot_csr', default=False, action='store_true', help='With --pivot, store the targets as CSR *_out_indptr/_indices/_data datasets of the score lines only, densified per minibatch by dna_io.read_targets; implies --pivot and --stream [Default: %default]')
+    parser.add_option('--append', dest='append', default=False, action='store_true', help='Append the sequences to the splits of an existing <out_file> written with --stream, checking its layout, sequence length, target labels and add_labels; implies --stream [Default: %default]')
+    parser.add_option('--cache', dest='cache_dir', default=None, help='Cache the encoded sequences in this directory, keyed by the content of the input sequence files and the sequence length, so later runs skip encoding; implies --stream [Default: %default]')
+    parser.add_option('--cache_size', dest='cache_size', default=50, type='float', help='Evict the least recently used cache entries beyond this many GB [Default: %default]')
+    parser.add_option('--report', dest='report_file', default=None, help='Write a JSON run report with the time, records and bases per second and peak resident memory of each stage [Default: %default]')
+    parser.add_option('--log_interval', dest='log_interval', default=None, type='float', help='Log the progress of the current stage to stderr every this many seconds [Default: %default]')
+    parser.add_option('--bench_read', dest='bench_batches', default=0, type='int', help='After writing, time this many random minibatch reads of train_in under several chunk/filter layouts [Default: %default]')
     (options,args) = parser.parse_args()
 
     if len(args) != 3:
@@ -46,30 +75,83 @@ def main():
     # seed rng before shuffle
     npr.seed(options.random_seed)
 
+    if options.vcf_file:
+        if not options.bed_file:
+            parser.error('--vcf requires --bed regions')
+        options.stream = True
+    if options.sparse or options.dedup:
+        options.stream = True
+    if options.pivot_csr:
+        options.pivot = True
+    if options.cache_dir or options.append or options.pivot_csr or options.codes:
+        options.stream = True
+    if options.hash_split:
+        if options.counts:
+            parser.error('--hash_split takes -v and -t as fractions, not counts (-c)')
+        options.stream = True
+    if options.sparse and options.dedup:
+        parser.error('--sparse and --dedup are exclusive')
+
+    if options.report_file or options.log_interval:
+        run_stats.start_run(options.log_interval)
+
+    if options.stream:
+        if options.vcf_file:
+            print('Read variants')
+            cache = None
+            if options.cache_dir:
+                cache = dna_io.cache_entry(options.cache_dir, [fasta_file, options.vcf_file, options.bed_file])
+            with run_stats.stage('read_variants'):
+                regions = dna_io.read_bed(options.bed_file)
+                samples, variants = dna_io.read_vcf(options.vcf_file, set(region[0] for region in regions))
+                headers, seq_lens = dna_io.variant_headers(regions, samples, dna_io.index_fasta(fasta_file))
+                records = dna_io.variant_records(fasta_file, regions, samples, variants)
+
+            # every sample of a region shares the reference window
+            groups = np.repeat(np.arange(len(regions)), len(samples))
+            fai = dna_io.index_fasta(fasta_file)
+            ref_in = open(fasta_file, 'rb')
+            window_seqs = lambda group: dna_io.fetch_fasta(ref_in, fai, *regions[group][:3])
+        else:
+            print('Index DNA')
+            cache = None
+            with run_stats.stage('index_dna'):
+                if options.cache_dir:
+                    cache = dna_io.cache_entry(options.cache_dir, [fasta_file])
+                    headers, seq_lens = dna_io.cached_lengths(cache, fasta_file)
+                else:
+                    headers, seq_lens = dna_io.fasta_lengths(fasta_file)
+            records = dna_io.read_fasta(fasta_file)
+
+            sep = options.sparse_sep.encode('ascii')
+            groups = pd.factorize(np.array([header.rsplit(sep, 1)[0] for header in headers], dtype='S'))[0]
+            ref_in = None
+            window_seqs = None
+
+        with run_stats.stage('stream_hdf5'):
+            stream_hdf5(headers, seq_lens, records, targets_file, out_file, options, groups, window_seqs, cache)
+        if ref_in is not None:
+            ref_in.close()
+        if options.cache_dir:
+            dna_io.evict_cache(options.cache_dir, options.cache_size * 2**30, keep=cache)
+        if options.bench_batches > 0:
+            with run_stats.stage('bench_read'):
+                bench_read(out_file, options)
+
+        run_stats.end_run(options.report_file)
+        return
+
     #################################################################
     # load data
     #################################################################
 
     print('Read DNA')
-    seqs, targets, seq_annot = dna_io.load_data_1hot(fasta_file, targets_file, extend_len=options.extend_length, mean_norm=False, whiten=False, permute=False, sort=False)
+    with run_stats.stage('read_dna'):
+        seqs, targets, seq_annot, headers, target_labels, records = dna_io.load_data_1hot(fasta_file, targets_file, extend_len=options.extend_length, mean_norm=False, whiten=False, permute=False, sort=False, return_headers=True, workers=options.workers, annot_codes=True, return_records=True, pivot=options.pivot, pivot_fill=options.pivot_fill)
 
-    # reshape sequences for torch    
+    # reshape sequences for torch (a view of the encoded rows, no copy)
     print('Reshape sequences')
-    seqs = seqs.reshape((seqs.shape[0],4,1,seqs.shape[1]/4))
-
-    # read headers    
-    print('Read headers')
-    headers = []
-    for line in gzip.open(fasta_file):
-        if line[0] == '>':
-            headers.append(line[1:].rstrip())
-    headers = np.array(headers)
-
-    # read labels
-    # target_labels = open(targets_file).readline().strip().split('\t')
-
-    target_labels = np.unique( [seq_annot[i][0] for i in range(1, len(seq_annot))])
-    # target_labels = [seq_annot[i][1] for i in range(1, len(seq_annot))]
+    seqs = seqs.reshape((seqs.shape[0],4,1,seqs.shape[1]//4))
 
     # read additional features
     if options.add_features_file:
@@ -82,28 +164,122 @@ def main():
         seqs = seqs[order]
         targets = targets[order]
         headers = headers[order]
-        seq_annot = seq_annot[order]
+        records = records[order]
+        if not options.pivot:
+            seq_annot = seq_annot[order]
 
         if options.add_features_file:
             df_add = df_add.iloc[order]
 
+    #################################################################
+    # divide data
+    #################################################################
+    train_count, valid_count, test_count = split_counts(seqs.shape[0], options)
+
+    # with --pivot the labels are the target columns and no *_annot is
+    # written; a placeholder of zeros is divided along with the rows
+    if options.pivot:
+        seq_annot = np.zeros(seqs.shape[0], dtype='int32')
+
+    i = 0
+    train_seqs, train_targets, train_annot, train_records = seqs[i:i+train_count,:], targets[i:i+train_count,:], seq_annot[i:i+train_count], records[i:i+train_count]
+    i += train_count
+    valid_seqs, valid_targets, valid_annot, valid_headers, valid_records = seqs[i:i+valid_count,:], targets[i:i+valid_count,:], seq_annot[i:i+valid_count], headers[i:i+valid_count], records[i:i+valid_count]
+    i += valid_count
+    test_seqs, test_targets, test_annot, test_headers, test_records = seqs[i:i+test_count,:], targets[i:i+test_count,:], seq_annot[i:i+test_count], headers[i:i+test_count], records[i:i+test_count]
+
+    if options.add_features_file:
+        i = 0
+        train_add = df_add.iloc[i:i+train_count]
+        i += train_count
+        valid_add = df_add.iloc[i:i+valid_count]
+        i += valid_count
+        test_add = df_add.iloc[i:i+test_count]
+
+    #################################################################
+    # construct hdf5 representation
+    #################################################################
+
+    print('Write hdf5')
+
+    # pdb.set_trace()
+
+    with run_stats.stage('write_hdf5'):
+        h5f = h5py.File(out_file, 'w')
+
+        h5f.create_dataset('target_labels', data=target_labels)
+
+        if train_count > 0:
+            h5f.create_dataset('train_in', data=train_seqs, **layout_kwargs(train_seqs.shape, options, dtype=train_seqs.dtype))
+            h5f.create_dataset('train_out', data=train_targets, **layout_kwargs(train_targets.shape, options, dtype=train_targets.dtype))
+            if not options.pivot:
+                h5f.create_dataset('train_annot', data=train_annot, **layout_kwargs(train_annot.shape, options, dtype=train_annot.dtype))
+            h5f.create_dataset('train_records', data=train_records, **layout_kwargs(train_records.shape, options, dtype=train_records.dtype))
+
+        if valid_count > 0:
+            h5f.create_dataset('valid_in', data=valid_seqs, **layout_kwargs(valid_seqs.shape, options, dtype=valid_seqs.dtype))
+            h5f.create_dataset('valid_out', data=valid_targets, **layout_kwargs(valid_targets.shape, options, dtype=valid_targets.dtype))
+            if not options.pivot:
+                h5f.create_dataset('valid_annot', data=valid_annot, **layout_kwargs(valid_annot.shape, options, dtype=valid_annot.dtype))
+            h5f.create_dataset('valid_records', data=valid_records, **layout_kwargs(valid_records.shape, options, dtype=valid_records.dtype))
+
+        if test_count > 0:
+            h5f.create_dataset('test_in', data=test_seqs, **layout_kwargs(test_seqs.shape, options, dtype=test_seqs.dtype))
+            h5f.create_dataset('test_out', data=test_targets, **layout_kwargs(test_targets.shape, options, dtype=test_targets.dtype))
+            if not options.pivot:
+                h5f.create_dataset('test_annot', data=test_annot, **layout_kwargs(test_annot.shape, options, dtype=test_annot.dtype))
+            h5f.create_dataset('test_records', data=test_records, **layout_kwargs(test_records.shape, options, dtype=test_records.dtype))
+            h5f.create_dataset('test_headers', data=test_headers)
+        elif options.valid_test:
+            h5f.create_dataset('test_in', data=valid_seqs, **layout_kwargs(valid_seqs.shape, options, dtype=valid_seqs.dtype))
+            h5f.create_dataset('test_out', data=valid_targets, **layout_kwargs(valid_targets.shape, options, dtype=valid_targets.dtype))
+            if not options.pivot:
+                h5f.create_dataset('test_annot', data=valid_annot, **layout_kwargs(valid_annot.shape, options, dtype=valid_annot.dtype))
+            h5f.create_dataset('test_records', data=valid_records, **layout_kwargs(valid_records.shape, options, dtype=valid_records.dtype))
+            h5f.create_dataset('test_headers', data=valid_headers)
+
+        if options.add_features_file:
+            h5f.create_dataset('add_labels', data=list(df_add.columns))
+
+            if train_count > 0:
+                h5f.create_dataset('train_add', data=train_add.values, **layout_kwargs(train_add.shape, options, dtype=train_add.values.dtype))
+            if valid_count > 0:
+                h5f.create_dataset('valid_add', data=valid_add.values, **layout_kwargs(valid_add.shape, options, dtype=valid_add.values.dtype))
+            if test_count > 0:
+                h5f.create_dataset('test_add', data=test_add.values, **layout_kwargs(test_add.shape, options, dtype=test_add.values.dtype))
+            elif options.valid_test:
+                h5f.create_dataset('test_add', data=valid_add.values, **layout_kwargs(valid_add.shape, options, dtype=valid_add.values.dtype))
+
+        h5f.close()
+        run_stats.count(seqs.shape[0], seqs.shape[0] * seqs.shape[-1])
+
+    if options.bench_batches > 0:
+        with run_stats.stage('bench_read'):
+            bench_read(out_file, options)
+
+    run_stats.end_run(options.report_file)
+
+
+################################################################################
+# split_counts
+#
+# Number of training, validation and test sequences out of num_seqs.
+################################################################################
+def split_counts(num_seqs, options):
     # check proper sum
     if options.counts:
-        assert(options.test_pct + options.valid_pct <= seqs.shape[0])
+        assert(options.test_pct + options.valid_pct <= num_seqs)
     else:
         assert(options.test_pct + options.valid_pct <= 1.0)
 
-    #################################################################
-    # divide data
-    #################################################################
     if options.counts:
         test_count = int(options.test_pct)
         valid_count = int(options.valid_pct)
     else:
-        test_count = int(0.5 + options.test_pct * seqs.shape[0])
-        valid_count = int(0.5 + options.valid_pct * seqs.shape[0])
+        test_count = int(0.5 + options.test_pct * num_seqs)
+        valid_count = int(0.5 + options.valid_pct * num_seqs)
 
-    train_count = seqs.shape[0] - test_count - valid_count
+    train_count = num_seqs - test_count - valid_count
     train_count = batch_round(train_count, options.batch_size)
     print('%d training sequences ' % train_count, file=sys.stderr)
 
@@ -113,63 +289,721 @@ def main():
     valid_count = batch_round(valid_count, options.batch_size)
     print('%d validation sequences ' % valid_count, file=sys.stderr)
 
-    i = 0
-    train_seqs, train_targets = seqs[i:i+train_count,:], targets[i:i+train_count,:]
-    i += train_count
-    valid_seqs, valid_targets, valid_headers = seqs[i:i+valid_count,:], targets[i:i+valid_count,:], headers[i:i+valid_count]
-    i += valid_count
-    test_seqs, test_targets, test_headers = seqs[i:i+test_count,:], targets[i:i+test_count,:], headers[i:i+test_count]
+    return train_count, valid_count, test_count
+
+
+################################################################################
+# stream_hdf5
+#
+# Build the HDF5 file without holding the data set in memory: the headers
+# and lengths of the records, e.g. from a first pass over the FASTA, size the
+# datasets, and a single pass over the records encodes and writes fixed-size
+# blocks of sequences, so memory is set by options.block_size rather than
+# the number of sequences. With -r the records are first spilled to a
+# scratch file and read back in permuted order, see dna_io.permute_records.
+#
+# Input
+#  headers:   Record headers.
+#  seq_lens:  Array of record lengths.
+#  records:   Iterator of (header, seq) records in the same order.
+#  groups:       Window of each record for --sparse, see write_sparse.
+#  window_seqs:  Function giving a group's window sequence for --sparse; by
+#                default the group's first record is its window.
+#  cache:        Cache entry of the records, see dna_io.cache_entry; the
+#                records are only read if their codes are not cached.
+################################################################################
+def stream_hdf5(headers, seq_lens, records, targets_file, out_file, options, groups=None, window_seqs=None, cache=None):
+    print('Read targets')
+    with run_stats.stage('read_targets'):
+        score_headers, label_codes, labels, scores = dna_io.read_scores(targets_file)
 
+    headers = np.array(headers, dtype='S')
+
+    # empty records and records without scores are dropped, as in load_data_1hot
+    seq_rows = np.flatnonzero(seq_lens > 0)
+    match_rows, score_rows = dna_io.join_headers(headers[seq_rows], score_headers)
+    seq_rows = seq_rows[match_rows]
+
+    # score row of every FASTA record, -1 if it is dropped
+    record_scores = np.full(len(headers), -1, dtype='int64')
+    record_scores[seq_rows] = score_rows
+
+    if options.extend_length is not None:
+        seq_len = options.extend_length
+    else:
+        seq_len = int(seq_lens[seq_rows].max())
+
+    if options.pivot:
+        # one column per label, see dna_io.pivot_scores
+        target_labels, targets_ptr, targets_cols, targets_data = dna_io.pivot_scores(headers, (score_headers, label_codes, labels, scores))
+        num_targets = len(target_labels)
+        out_dtype = dna_io.pivot_dtype(scores.dtype, options.pivot_fill)
+        block_targets = lambda rows: dna_io.csr_dense(targets_ptr, targets_cols, targets_data, rows, num_targets, options.pivot_fill, out_dtype)
+    else:
+        # annotations as int32 codes into target_labels
+        dna_io.check_single_label((score_headers, label_codes, labels, scores), headers[seq_rows])
+        target_labels, label_map = dna_io.sort_labels(label_codes[score_rows], labels)
+        score_annot = label_map[label_codes]
+        num_targets = 1
+        out_dtype = scores.dtype
+        block_targets = lambda rows: scores[record_scores[rows]][:,None]
+
+    # read additional features
     if options.add_features_file:
-        i = 0
-        train_add = df_add.iloc[i:i+train_count]
-        i += train_count
-        valid_add = df_add.iloc[i:i+valid_count]
-        i += valid_count
-        test_add = df_add.iloc[i:i+test_count]
+        df_add = pd.read_table(options.add_features_file, index_col=0)
+        df_add = df_add.astype(np.float32, copy=False)
+
+    if options.append:
+        h5f = h5py.File(out_file, 'r+')
+        add_labels = list(df_add.columns) if options.add_features_file else None
+        seq_len, label_cols = check_append(h5f, options, seq_len, target_labels, add_labels, headers.dtype, out_dtype)
+
+        # code the labels by the file's target_labels
+        target_labels = h5f['target_labels'][()]
+        if options.pivot:
+            targets_cols = label_cols[targets_cols]
+            num_targets = len(target_labels)
+        else:
+            score_annot = np.where(score_annot >= 0, label_cols[score_annot], -1)
+
+    # annotations are only added to files that have them
+    write_annot = not options.pivot and (not options.append or any(name.endswith('_annot') for name in h5f))
+    if not options.pivot and not write_annot:
+        print('%s has no *_annot; not writing annotations' % out_file, file=sys.stderr)
+
+    # permute, as npr.permutation in the in-memory path
+    if options.permute:
+        order = npr.permutation(len(seq_rows))
+    else:
+        order = np.arange(len(seq_rows))
 
     #################################################################
-    # construct hdf5 representation
+    # divide data
     #################################################################
+    # split of each scored record, in the order records are written
+    if options.hash_split:
+        split_keys = split_group_keys(headers[seq_rows], options)
+        seq_splits = dna_io.hash_split(split_keys, options.valid_pct, options.test_pct, options.random_seed)[order]
+        train_count, valid_count, test_count = np.bincount(seq_splits, minlength=3)
+        for name, count in [('training',train_count), ('test',test_count), ('validation',valid_count)]:
+            print('%d %s sequences ' % (count, name), file=sys.stderr)
+    else:
+        train_count, valid_count, test_count = split_counts(len(seq_rows), options)
+        seq_splits = np.full(len(seq_rows), -1, dtype='int8')
+        seq_splits[:train_count] = 0
+        seq_splits[train_count:train_count+valid_count] = 1
+        seq_splits[train_count+valid_count:train_count+valid_count+test_count] = 2
+
+    # (name, count, dataset prefixes written, positions in seq_rows in order)
+    splits = []
+    record_split = np.full(len(headers), -1, dtype='int8')
+    for si, (name, count) in enumerate([('train',train_count), ('valid',valid_count), ('test',test_count)]):
+        prefixes = [name]
+        if name == 'valid' and test_count == 0 and options.valid_test:
+            prefixes.append('test')
+        if count > 0:
+            split_seqs = order[seq_splits == si]
+            record_split[seq_rows[split_seqs]] = len(splits)
+            splits.append((name, count, prefixes, split_seqs))
 
+    #################################################################
+    # construct hdf5 representation
+    #################################################################
     print('Write hdf5')
 
-    # pdb.set_trace()
-    
-    h5f = h5py.File(out_file, 'w')
+    # with --append, the datasets exist and are grown by split_dataset
+    if not options.append:
+        h5f = h5py.File(out_file, 'w')
+        h5f.create_dataset('target_labels', data=target_labels)
 
-    h5f.create_dataset('target_labels', data=target_labels)
+    # rows record their FASTA record in *_records, counting on from the
+    # records of earlier files with --append; see dna_io.validate_hdf5
+    write_records = not options.append or 'fasta_records' in h5f.attrs
+    if write_records:
+        record0 = int(h5f.attrs.get('fasta_records', 0))
+    else:
+        print('%s has no *_records; not recording FASTA records' % out_file, file=sys.stderr)
+
+    # codes are decoded through code_table, see dna_io.decode_codes
+    if options.sparse:
+        if not options.append:
+            h5f.create_dataset('code_table', data=dna_io.code_vecs)
+            h5f.create_dataset('windows', shape=(0,seq_len), maxshape=(None,seq_len), chunks=(max(1, min(options.block_size, 1024, chunk_bytes // max(seq_len, 1))),seq_len), dtype='uint8')
+        group_windows = np.full(int(groups.max())+1 if len(groups) else 0, -1, dtype='int64')
+        in_shape, in_dtype = None, None
+    elif options.codes:
+        if not options.append:
+            h5f.create_dataset('code_table', data=dna_io.code_vecs)
+        in_shape, in_dtype = (seq_len,), 'uint8'
+    else:
+        in_shape, in_dtype = (4,1,seq_len), 'float16'
+
+    if options.dedup:
+        if not options.append:
+            unique_layout = layout_kwargs((options.block_size,)+in_shape, options, options.block_size, in_dtype)
+            h5f.create_dataset('seqs_unique', shape=(0,)+in_shape, maxshape=(None,)+in_shape, dtype=in_dtype, **unique_layout)
+        unique0 = h5f['seqs_unique'].shape[0]
+        unique_keys = {}
+
+    # first row written of each split
+    split_b0 = []
+    for name, count, prefixes, split_seqs in splits:
+        prefix_b0 = []
+        for prefix in prefixes:
+            if options.dedup:
+                prefix_b0.append(split_dataset(h5f, '%s_index' % prefix, count, (), 'int64', options))
+            elif options.sparse:
+                prefix_b0.append(split_dataset(h5f, '%s_window' % prefix, count, (), 'int64', options))
+                if '%s_diff_ptr' % prefix not in h5f:
+                    h5f.create_dataset('%s_diff_ptr' % prefix, data=np.zeros(1, dtype='int64'), maxshape=(None,), chunks=(options.block_size+1,))
+                    for diff_name, diff_dtype in [('diff_pos','int32'), ('diff_code','uint8')]:
+                        h5f.create_dataset('%s_%s' % (prefix, diff_name), shape=(0,), maxshape=(None,), chunks=(65536,), dtype=diff_dtype)
+            else:
+                prefix_b0.append(split_dataset(h5f, '%s_in' % prefix, count, in_shape, in_dtype, options))
+            if options.pivot_csr:
+                prefix_b0.append(csr_dataset(h5f, '%s_out' % prefix, num_targets, out_dtype, options.pivot_fill))
+            else:
+                prefix_b0.append(split_dataset(h5f, '%s_out' % prefix, count, (num_targets,), out_dtype, options))
+            if write_annot:
+                prefix_b0.append(split_dataset(h5f, '%s_annot' % prefix, count, (), 'int32', options))
+            if write_records:
+                prefix_b0.append(split_dataset(h5f, '%s_records' % prefix, count, (), 'int64', options))
+            if prefix == 'test':
+                prefix_b0.append(split_dataset(h5f, 'test_headers', count, (), headers.dtype, options, layout=False))
+
+        if len(set(prefix_b0)) > 1:
+            raise ValueError('Datasets of %s have different lengths in %s' % (name, out_file))
+        split_b0.append(prefix_b0[0])
+
+    # encode in one pass, routing each block's records to their splits
+    # records are keyed by FASTA position
+    if cache is not None:
+        # cached codes are read in any order, no need to spill to permute
+        with run_stats.stage('cache_codes'):
+            seq_codes = dna_io.cached_codes(cache, records, len(headers), seq_len, options.block_size, options.workers)
+        records = ((ri, seq_codes[ri]) for ri in seq_rows[order] if record_split[ri] >= 0)
+    else:
+        records = ((ri, seq) for ri, (header, seq) in enumerate(records) if record_scores[ri] >= 0)
+        if options.permute:
+            records = dna_io.permute_records(records, order)
+        records = ((ri, seq) for ri, seq in records if record_split[ri] >= 0)
+
+    if options.dedup:
+        dedup_rows = array.array('q')
+        records = dedup_records(records, dedup_rows, unique_keys)
+
+    block_codes = options.codes or options.sparse
+    if cache is not None:
+        blocks = dna_io.code_blocks(records, options.block_size, block_codes)
+    else:
+        blocks = dna_io.encode_blocks(records, seq_len, options.block_size, options.workers, block_codes)
+    with run_stats.stage('encode_write'):
+        for block_rows, block_seqs in blocks:
+            run_stats.count(len(block_rows), int(seq_lens[block_rows].sum()))
+            if options.dedup:
+                seqs_unique = h5f['seqs_unique']
+                u0 = seqs_unique.shape[0]
+                seqs_unique.resize((u0+len(block_rows),) + seqs_unique.shape[1:])
+                seqs_unique[u0:] = block_seqs
+                continue
+
+            block_rows = np.asarray(block_rows)
+            block_splits = record_split[block_rows]
+            for si, (name, count, prefixes, split_seqs) in enumerate(splits):
+                if (block_splits == si).all():
+                    rows, seqs = block_rows, block_seqs
+                else:
+                    rows, seqs = block_rows[block_splits == si], block_seqs[block_splits == si]
+                    if len(rows) == 0:
+                        continue
+
+                b0 = split_b0[si]
+                b1 = b0 + len(rows)
+                for prefix in prefixes:
+                    if options.sparse:
+                        write_sparse(h5f, prefix, b0, seqs, groups[rows], group_windows, window_seqs)
+                    else:
+                        h5f['%s_in' % prefix][b0:b1] = seqs
+                    if options.pivot_csr:
+                        write_csr(h5f, '%s_out' % prefix, b0, targets_ptr, targets_cols, targets_data, rows)
+                    else:
+                        h5f['%s_out' % prefix][b0:b1] = block_targets(rows)
+                    if write_annot:
+                        h5f['%s_annot' % prefix][b0:b1] = score_annot[record_scores[rows]]
+                    if write_records:
+                        h5f['%s_records' % prefix][b0:b1] = record0 + rows
+                    if prefix == 'test':
+                        h5f['test_headers'][b0:b1] = headers[rows]
+                split_b0[si] = b1
+
+    if options.dedup:
+        # rows come back as (record, unique index) once all are read
+        dedup_rows = np.frombuffer(dedup_rows, dtype='int64').reshape((-1,2))
+        dedup_splits = record_split[dedup_rows[:,0]]
+        for si, (name, count, prefixes, split_seqs) in enumerate(splits):
+            split_rows = dedup_rows[dedup_splits == si]
+            for r0 in range(0, count, options.block_size):
+                block_rows = split_rows[r0:r0+options.block_size,0]
+                b0 = split_b0[si] + r0
+                b1 = b0 + len(block_rows)
+                for prefix in prefixes:
+                    h5f['%s_index' % prefix][b0:b1] = unique0 + split_rows[r0:r0+len(block_rows),1]
+                    if options.pivot_csr:
+                        write_csr(h5f, '%s_out' % prefix, b0, targets_ptr, targets_cols, targets_data, block_rows)
+                    else:
+                        h5f['%s_out' % prefix][b0:b1] = block_targets(block_rows)
+                    if write_annot:
+                        h5f['%s_annot' % prefix][b0:b1] = score_annot[record_scores[block_rows]]
+                    if write_records:
+                        h5f['%s_records' % prefix][b0:b1] = record0 + block_rows
+                    if prefix == 'test':
+                        h5f['test_headers'][b0:b1] = headers[block_rows]
+        print(' distinct sequences: %d' % h5f['seqs_unique'].shape[0], file=sys.stderr)
+
+    for name, count, prefixes, split_seqs in splits:
+        print(' %s sequences written: %d' % (name, count), file=sys.stderr)
 
-    if train_count > 0:
-        h5f.create_dataset('train_in', data=train_seqs)
-        h5f.create_dataset('train_out', data=train_targets)
+    if options.add_features_file:
+        if not options.append:
+            h5f.create_dataset('add_labels', data=list(df_add.columns))
+        for name, count, prefixes, split_seqs in splits:
+            for prefix in prefixes:
+                split_add = df_add.iloc[split_seqs].values
+                a0 = split_dataset(h5f, '%s_add' % prefix, count, split_add.shape[1:], split_add.dtype, options)
+                h5f['%s_add' % prefix][a0:] = split_add
+
+    # counted only once every row is written
+    if write_records:
+        h5f.attrs['fasta_records'] = record0 + len(headers)
 
-    if valid_count > 0:
-        h5f.create_dataset('valid_in', data=valid_seqs)
-        h5f.create_dataset('valid_out', data=valid_targets)
+    h5f.close()
 
-    if test_count > 0:
-        h5f.create_dataset('test_in', data=test_seqs)
-        h5f.create_dataset('test_out', data=test_targets)
-        h5f.create_dataset('test_headers', data=test_headers)
-    elif options.valid_test:
-        h5f.create_dataset('test_in', data=valid_seqs)
-        h5f.create_dataset('test_out', data=valid_targets)
-        h5f.create_dataset('test_headers', data=valid_headers)
 
-    if options.add_features_file:
-        h5f.create_dataset('add_labels', data=list(df_add.columns))
+################################################################################
+# check_append
+#
+# Check that the file being appended to was written with the same layout,
+# sequence length and additional feature labels, that its target_labels
+# hold the new labels, and that every split's datasets are resizable, of
+# equal length and take the new rows, and return its sequence length and
+# where the new labels are in its target_labels. Nothing is written until
+# all of this holds, so a rejected append leaves the file as it was.
+#
+# Input
+#  h5f:            HDF5 file open for appending.
+#  options:        Command line options.
+#  seq_len:        Sequence length of the new records.
+#  target_labels:  Target labels of the new records.
+#  add_labels:     Additional feature labels, or None.
+#  header_dtype:   dtype of the new headers.
+#  out_dtype:      dtype of the new targets.
+#
+# Output
+#  file_len:       Sequence length of the file.
+#  label_cols:     int32 position of each new label in the file's
+#                  target_labels.
+################################################################################
+def check_append(h5f, options, seq_len, target_labels, add_labels, header_dtype, out_dtype):
+    if 'seqs_unique' in h5f:
+        layout, file_len = 'dedup', h5f['seqs_unique'].shape[-1]
+    elif 'windows' in h5f:
+        layout, file_len = 'sparse', h5f['windows'].shape[1]
+    else:
+        seqs_in = [h5f[name] for name in h5f if name.endswith('_in')]
+        if not seqs_in:
+            raise ValueError('No sequence datasets to append to in %s' % h5f.filename)
+        layout = 'codes' if seqs_in[0].dtype == np.uint8 else 'one hot'
+        file_len = seqs_in[0].shape[-1]
+
+    if options.dedup:
+        new_layout = 'dedup'
+    elif options.sparse:
+        new_layout = 'sparse'
+    else:
+        new_layout = 'codes' if options.codes else 'one hot'
+    if new_layout != layout:
+        raise ValueError('%s is in the %s layout, not %s' % (h5f.filename, layout, new_layout))
+    if layout == 'dedup' and ('code_table' in h5f) != bool(options.codes):
+        raise ValueError('%s and --codes disagree on the dedup sequence encoding' % h5f.filename)
+
+    # without -e, shorter new records are padded to the file's length
+    if options.extend_length is not None and options.extend_length != file_len:
+        raise ValueError('Sequence length %d differs from %d in %s' % (options.extend_length, file_len, h5f.filename))
+    if seq_len > file_len:
+        raise ValueError('Sequences of length %d exceed %d in %s' % (seq_len, file_len, h5f.filename))
+
+    if any(name.endswith('_out_indptr') for name in h5f) != bool(options.pivot_csr):
+        raise ValueError('%s and --pivot_csr disagree on the target layout' % h5f.filename)
+
+    label_cols = pd.Index(h5f['target_labels'][()]).get_indexer(np.asarray(target_labels)).astype('int32')
+    if (label_cols < 0).any():
+        new_labels = np.asarray(target_labels)[label_cols < 0][:5].astype(str)
+        raise ValueError('%d target labels are not in target_labels of %s, e.g. %s' % ((label_cols < 0).sum(), h5f.filename, ', '.join(new_labels)))
+
+    file_add = list(h5f['add_labels'][()].astype(str)) if 'add_labels' in h5f else None
+    if file_add != add_labels:
+        raise ValueError('Additional feature labels differ from those of %s' % h5f.filename)
+
+    if 'test_headers' in h5f and h5f['test_headers'].dtype.itemsize < header_dtype.itemsize:
+        raise ValueError('Headers longer than the %d bytes of test_headers in %s' % (h5f['test_headers'].dtype.itemsize, h5f.filename))
+
+    # annotations are only added to files that have them, and --pivot has none
+    has_annot = any(name.endswith('_annot') for name in h5f)
+    if options.pivot and has_annot:
+        raise ValueError('%s has *_annot, which --pivot targets cannot extend' % h5f.filename)
+
+    # (row shape, dtype) of the datasets of every split
+    num_targets = len(h5f['target_labels']) if options.pivot else 1
+    row_specs = {}
+    if layout == 'dedup':
+        row_specs['index'] = ((), 'int64')
+    elif layout == 'sparse':
+        row_specs['window'] = ((), 'int64')
+    elif layout == 'codes':
+        row_specs['in'] = ((file_len,), 'uint8')
+    else:
+        row_specs['in'] = ((4,1,file_len), 'float16')
+    if not options.pivot_csr:
+        row_specs['out'] = ((num_targets,), out_dtype)
+    if has_annot:
+        row_specs['annot'] = ((), 'int32')
+    if 'fasta_records' in h5f.attrs:
+        row_specs['records'] = ((), 'int64')
+    if add_labels is not None:
+        row_specs['add'] = ((len(add_labels),), 'float32')
+
+    for name in ['seqs_unique', 'windows']:
+        if name in h5f and h5f[name].maxshape[0] is not None:
+            raise ValueError('%s is not resizable; rebuild it with --stream to append' % name)
+
+    for prefix in ['train', 'valid', 'test']:
+        if not any(name.startswith('%s_' % prefix) for name in h5f):
+            continue
+
+        # rows of each dataset of the split
+        split_rows = {}
+        for suffix, (row_shape, dtype) in row_specs.items():
+            name = '%s_%s' % (prefix, suffix)
+            if name not in h5f:
+                raise ValueError('%s has no %s to append to' % (h5f.filename, name))
+            data = h5f[name]
+            if data.maxshape[0] is not None:
+                raise ValueError('%s is not resizable; rebuild it with --stream to append' % name)
+            if data.shape[1:] != row_shape:
+                raise ValueError('%s has rows of shape %s, not %s' % (name, data.shape[1:], row_shape))
+            # targets may widen into the file's dtype, the rest must match
+            if suffix == 'out' and not np.can_cast(dtype, data.dtype):
+                raise ValueError('%s of dtype %s cannot hold %s targets' % (name, data.dtype, np.dtype(dtype)))
+            if suffix != 'out' and data.dtype != np.dtype(dtype):
+                raise ValueError('%s has dtype %s, not %s' % (name, data.dtype, np.dtype(dtype)))
+            split_rows[name] = data.shape[0]
+
+        # pointer datasets hold one more entry than rows
+        ptr_names = []
+        if options.pivot_csr:
+            ptr_names.append('%s_out_indptr' % prefix)
+        if layout == 'sparse':
+            ptr_names.append('%s_diff_ptr' % prefix)
+        for name in ptr_names:
+            if name not in h5f:
+                raise ValueError('%s has no %s to append to' % (h5f.filename, name))
+            split_rows[name] = h5f[name].shape[0] - 1
+
+        if options.pivot_csr:
+            indptr = h5f['%s_out_indptr' % prefix]
+            if int(indptr.attrs['num_cols']) != num_targets or indptr.attrs['fill'] != options.pivot_fill:
+                raise ValueError('%s_out has %d columns filled with %s, not %d filled with %s' % (prefix, indptr.attrs['num_cols'], indptr.attrs['fill'], num_targets, options.pivot_fill))
+            if not np.can_cast(out_dtype, indptr.attrs['dtype']):
+                raise ValueError('%s_out of dtype %s cannot hold %s targets' % (prefix, indptr.attrs['dtype'], np.dtype(out_dtype)))
+
+        if prefix == 'test' and 'test_headers' in h5f:
+            split_rows['test_headers'] = h5f['test_headers'].shape[0]
+
+        if len(set(split_rows.values())) > 1:
+            raise ValueError('Datasets of %s have different lengths in %s: %s' % (prefix, h5f.filename, ', '.join('%s %d' % nr for nr in sorted(split_rows.items()))))
+
+    return file_len, label_cols
 
-        if train_count > 0:
-            h5f.create_dataset('train_add', data=train_add.as_matrix())
-        if valid_count > 0:
-            h5f.create_dataset('valid_add', data=valid_add.as_matrix())
-        if test_count > 0:
-            h5f.create_dataset('test_add', data=test_add.as_matrix())
-        elif options.valid_test:
-            h5f.create_dataset('test_add', data=valid_add.as_matrix())
 
-    h5f.close()
+################################################################################
+# split_dataset
+#
+# Create a resizable per-sequence dataset of count rows, or with --append
+# grow the existing one by count rows, and return its first new row.
+################################################################################
+def split_dataset(h5f, name, count, row_shape, dtype, options, layout=True):
+    row_shape = tuple(row_shape)
+
+    if name in h5f:
+        data = h5f[name]
+        if data.maxshape[0] is not None:
+            raise ValueError('%s is not resizable; rebuild it with --stream to append' % name)
+        if data.shape[1:] != row_shape:
+            raise ValueError('%s has rows of shape %s, not %s' % (name, data.shape[1:], row_shape))
+        r0 = data.shape[0]
+        data.resize((r0+count,) + row_shape)
+        return r0
+
+    kwargs = layout_kwargs((count,)+row_shape, options, options.block_size, dtype) if layout else {}
+    h5f.create_dataset(name, shape=(count,)+row_shape, maxshape=(None,)+row_shape, dtype=dtype, **kwargs)
+    return 0
+
+
+################################################################################
+# split_group_keys
+#
+# Keys hashed by --hash_split: the headers, or their <region> or <sample>
+# part around the last options.sparse_sep.
+################################################################################
+def split_group_keys(headers, options):
+    if options.hash_group == 'header':
+        return headers
+
+    sep = options.sparse_sep.encode('ascii')
+    part = 0 if options.hash_group == 'region' else -1
+    return np.array([header.rsplit(sep, 1)[part] for header in headers], dtype='S')
+
+
+################################################################################
+# dedup_records
+#
+# Pass on only the first record of each distinct sequence, by a hash of its
+# content, appending (record, unique index) of every record to split_rows.
+#
+# Input
+#  records:      Iterator of (record index, seq).
+#  split_rows:   Array to extend with (record index, unique index) pairs.
+#  unique_keys:  Dict mapping content digests to unique indexes, updated.
+################################################################################
+def dedup_records(records, split_rows, unique_keys):
+    for ri, seq in records:
+        key = hashlib.sha1(dna_io.seq_bytes(seq)).digest()
+        ui = unique_keys.get(key)
+        if ui is None:
+            ui = len(unique_keys)
+            unique_keys[key] = ui
+            yield ri, seq
+        split_rows.extend((ri, ui))
+
+
+################################################################################
+# write_sparse
+#
+# Write a block of sequence codes in the sparse layout: each group's window,
+# window_seqs(group) or else the group's first sequence, is appended to
+# windows the first time the group is seen, and each sequence is stored as
+# the index of its group's window (prefix_window) and the positions and codes
+# where it differs (prefix_diff_pos, prefix_diff_code), delimited per
+# sequence by prefix_diff_ptr as in CSR. See dna_io.read_sparse. Only the
+# window index of each group is kept; a block's windows are read back from
+# the file, so memory does not grow with the windows written.
+#
+# Input
+#  prefix:         Dataset prefix, e.g. train.
+#  b0:             First row of the block.
+#  block_codes:    Block of sequence codes.
+#  block_groups:   Group of each sequence.
+#  group_windows:  int64 array of each group's window index, -1 until its
+#                  window is written; updated.
+#  window_seqs:    Optional function giving a group's window sequence.
+################################################################################
+def write_sparse(h5f, prefix, b0, block_codes, block_groups, group_windows, window_seqs=None):
+    windows = h5f['windows']
+
+    # append windows of new groups, in order of first sequence
+    new_rows = np.flatnonzero(group_windows[block_groups] < 0)
+    new_groups, new_first = np.unique(block_groups[new_rows], return_index=True)
+    if len(new_groups) > 0:
+        first_order = np.argsort(new_first)
+        new_groups, new_first = new_groups[first_order], new_first[first_order]
+        if window_seqs is None:
+            new_codes = block_codes[new_rows[new_first]]
+        else:
+            new_codes = dna_io.encode_codes_batch([window_seqs(group) for group in new_groups], windows.shape[1])
+
+        w0 = windows.shape[0]
+        windows.resize((w0+len(new_groups), windows.shape[1]))
+        windows[w0:] = new_codes
+        group_windows[new_groups] = w0 + np.arange(len(new_groups))
+
+    # h5py reads increasing indexes, so read each window once
+    block_windows = group_windows[block_groups]
+    window_idx, seq_window_idx = np.unique(block_windows, return_inverse=True)
+    window_codes = windows[window_idx][seq_window_idx.ravel()]
+
+    rows, pos = np.nonzero(block_codes != window_codes)
+    diff_codes = block_codes[rows, pos]
+
+    diff_ptr = h5f['%s_diff_ptr' % prefix]
+    nnz = int(diff_ptr[-1])
+    block_ptr = nnz + np.cumsum(np.bincount(rows, minlength=len(block_codes)))
+
+    h5f['%s_window' % prefix][b0:b0+len(block_codes)] = block_windows
+    diff_ptr.resize((diff_ptr.shape[0]+len(block_codes),))
+    diff_ptr[b0+1:b0+1+len(block_codes)] = block_ptr
+
+    for diff_name, diff_values in [('diff_pos',pos), ('diff_code',diff_codes)]:
+        diff_data = h5f['%s_%s' % (prefix, diff_name)]
+        diff_data.resize((nnz+len(diff_values),))
+        diff_data[nnz:] = diff_values
+
+
+################################################################################
+# csr_dataset
+#
+# Create the CSR datasets of a targets matrix, name_indptr, name_indices and
+# name_data, unless they exist, and return their number of rows. The
+# indptr dataset records the number of columns, the fill value of entries
+# not stored and the dense dtype for dna_io.read_targets.
+################################################################################
+def csr_dataset(h5f, name, num_cols, dtype, fill):
+    if '%s_indptr' % name not in h5f:
+        indptr = h5f.create_dataset('%s_indptr' % name, data=np.zeros(1, dtype='int64'), maxshape=(None,), chunks=(65536,))
+        indptr.attrs['num_cols'] = num_cols
+        indptr.attrs['fill'] = fill
+        indptr.attrs['dtype'] = np.dtype(dtype).str
+        h5f.create_dataset('%s_indices' % name, shape=(0,), maxshape=(None,), chunks=(65536,), dtype='int32')
+        h5f.create_dataset('%s_data' % name, shape=(0,), maxshape=(None,), chunks=(65536,), dtype=dtype)
+
+    return h5f['%s_indptr' % name].shape[0] - 1
+
+
+################################################################################
+# write_csr
+#
+# Append rows of a CSR matrix to the CSR datasets of name, starting at row b0.
+################################################################################
+def write_csr(h5f, name, b0, indptr, indices, data, rows):
+    rows = np.asarray(rows)
+    starts = indptr[rows]
+    lens = indptr[rows+1] - starts
+    entries = np.repeat(starts - (np.cumsum(lens) - lens), lens) + np.arange(lens.sum())
+
+    out_ptr = h5f['%s_indptr' % name]
+    nnz = int(out_ptr[b0])
+    out_ptr.resize((b0+1+len(rows),))
+    out_ptr[b0+1:] = nnz + np.cumsum(lens)
+
+    for part, values in [('indices',indices[entries]), ('data',data[entries])]:
+        out_part = h5f['%s_%s' % (name, part)]
+        out_part.resize((nnz+len(values),))
+        out_part[nnz:] = values
+
+
+################################################################################
+# layout_kwargs
+#
+# create_dataset keyword arguments for the chunk shape and filters of a
+# per-sequence dataset. Chunks hold whole rows, options.chunk_rows of them or
+# by default one training batch (-b), so a minibatch read touches as few
+# chunks as possible. Without either, default chunks are capped at about
+# chunk_bytes, near the HDF5 chunk cache, however long the rows.
+#
+# Input
+#  shape:         Dataset shape.
+#  options:       Command line options.
+#  default_rows:  Rows per chunk if neither --chunk nor -b are given; None
+#                 leaves the dataset contiguous unless it must be chunked.
+#  dtype:         Dataset dtype, to cap the default chunk rows by bytes.
+################################################################################
+chunk_bytes = 2**20
+
+def layout_kwargs(shape, options, default_rows=None, dtype=None):
+    chunk_rows = options.chunk_rows or options.batch_size
+
+    kwargs = {}
+    if options.compression:
+        kwargs['compression'] = options.compression
+        if options.compression_level is not None:
+            kwargs['compression_opts'] = options.compression_level
+    if options.shuffle:
+        kwargs['shuffle'] = True
+
+    # filters require chunking
+    if not chunk_rows:
+        chunk_rows = default_rows or (1024 if kwargs else None)
+        if chunk_rows and dtype is not None:
+            row_bytes = np.dtype(dtype).itemsize * int(np.prod(shape[1:]))
+            chunk_rows = max(1, min(chunk_rows, chunk_bytes // max(row_bytes, 1)))
+
+    if chunk_rows and shape[0] > 0:
+        kwargs['chunks'] = (min(chunk_rows, shape[0]),) + tuple(shape[1:])
+
+    return kwargs
+
+
+################################################################################
+# bench_read
+#
+# Time random minibatch reads of train_in from out_file copied under several
+# chunk and filter layouts, and print the file size and read throughput of
+# each, to choose a layout for a training loader.
+################################################################################
+BENCH_LAYOUTS = [
+    ('contiguous', None, None, False),
+    ('chunked', 1, None, False),
+    ('chunked+lzf', 1, 'lzf', False),
+    ('chunked+gzip', 1, 'gzip', False),
+    ('chunked+shuffle+gzip', 1, 'gzip', True)]
+
+def bench_read(out_file, options):
+    batch_size = options.batch_size or 128
+    batches = options.bench_batches
+
+    with h5py.File(out_file, 'r') as h5_in:
+        if 'train_in' not in h5_in:
+            print('No train_in to benchmark', file=sys.stderr)
+            return
+        train_in = h5_in['train_in']
+        num_seqs = train_in.shape[0]
+        num_starts = max(1, num_seqs - batch_size + 1)
+
+        bench_dir = tempfile.mkdtemp()
+        print('%-22s %10s %10s %12s %12s' % ('layout', 'chunk', 'MB', 'batch MB/s', 'rows MB/s'))
+
+        for name, chunk_batches, compression, shuffle in BENCH_LAYOUTS:
+            bench_file = os.path.join(bench_dir, '%s.h5' % name)
+            kwargs = {}
+            if chunk_batches:
+                kwargs['chunks'] = (min(num_seqs, chunk_batches*batch_size),) + train_in.shape[1:]
+            if compression:
+                kwargs['compression'] = compression
+            if shuffle:
+                kwargs['shuffle'] = True
+
+            # copy train_in under this layout
+            h5_bench = h5py.File(bench_file, 'w')
+            bench_in = h5_bench.create_dataset('train_in', shape=train_in.shape, dtype=train_in.dtype, **kwargs)
+            for b0 in range(0, num_seqs, options.block_size):
+                bench_in[b0:b0+options.block_size] = train_in[b0:b0+options.block_size]
+            h5_bench.close()
+            file_mb = os.path.getsize(bench_file) / 1e6
+
+            h5_bench = h5py.File(bench_file, 'r')
+            bench_in = h5_bench['train_in']
+            rows_bytes = min(batch_size, num_seqs) * bench_in.dtype.itemsize * int(np.prod(bench_in.shape[1:]))
+
+            # contiguous batches at random offsets
+            starts = npr.randint(0, num_starts, size=batches)
+            t0 = time.time()
+            for b0 in starts:
+                bench_in[b0:b0+batch_size]
+            batch_mbs = batches * rows_bytes / 1e6 / max(time.time()-t0, 1e-9)
+
+            # batches of random rows
+            t0 = time.time()
+            for bi in range(batches):
+                rows = np.sort(npr.choice(num_seqs, min(batch_size, num_seqs), replace=False))
+                bench_in[rows]
+            rows_mbs = batches * rows_bytes / 1e6 / max(time.time()-t0, 1e-9)
+
+            h5_bench.close()
+            os.remove(bench_file)
+
+            chunk_str = str(kwargs['chunks'][0]) if 'chunks' in kwargs else '-'
+            print('%-22s %10s %10.1f %12.1f %12.1f' % (name, chunk_str, file_mb, batch_mbs, rows_mbs))
+
+        os.rmdir(bench_dir)
 
 
 def batch_round(count, batch_size):
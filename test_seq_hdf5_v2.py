@@ -0,0 +1,483 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import gzip
+import itertools
+import sys
+
+import h5py
+import numpy as np
+import pytest
+
+import dna_io_v2 as dna_io
+import seq_hdf5_v2
+
+################################################################################
+# test_seq_hdf5_v2.py
+#
+# Round-trip checks of the HDF5 files written by seq_hdf5_v2.py: every
+# layout and split option is compared against a plain build of the same
+# synthetic data, run with pytest.
+################################################################################
+
+################################################################################
+# write_data
+#
+# Write a gzipped FASTA of regions x samples records named <region>_<sample>,
+# each sample a copy of its region's sequence with a few IUPAC or N changes
+# (some unchanged, so sequences repeat), an empty record, and a melted scores
+# file with one line per record.
+#
+# Input
+#  fasta_file:   Output FASTA file.
+#  scores_file:  Output scores file.
+#  regions:      Number of regions.
+#  samples:      Samples per region.
+#  labels:       Labels drawn for the score lines.
+#  skip:         Headers left without a score line.
+#  seed:         Seed of the data.
+#
+# Output
+#  headers:      Headers of the non-empty records, in FASTA order.
+################################################################################
+def write_data(fasta_file, scores_file, regions=40, samples=6, labels=('a','b','c'), skip=(), seed=1):
+    rng = np.random.RandomState(seed)
+    nts = np.frombuffer(b'ACGT', dtype='uint8')
+    changes = np.frombuffer(b'NMRWSYKacgt', dtype='uint8')
+
+    headers = []
+    with gzip.open(fasta_file, 'wb') as fasta_out:
+        for ri in range(regions):
+            region_seq = nts[rng.randint(0, 4, size=rng.randint(20, 41))]
+            for si in range(samples):
+                seq = region_seq.copy()
+                if rng.random_sample() < 0.7:
+                    pos = rng.randint(0, len(seq), size=rng.randint(1, 4))
+                    seq[pos] = changes[rng.randint(0, len(changes), size=len(pos))]
+                header = 'r%d_s%d' % (ri, si)
+                headers.append(header)
+                fasta_out.write(b'>' + header.encode('ascii') + b'\n' + seq.tobytes() + b'\n')
+            if ri == regions // 2:
+                fasta_out.write(b'>empty\n\n')
+
+    with gzip.open(scores_file, 'wt') as scores_out:
+        print('id\tlabel\tscore', file=scores_out)
+        for header in headers:
+            if header not in skip:
+                print('%s\t%s\t%.2f' % (header, labels[rng.randint(0, len(labels))], rng.random_sample()), file=scores_out)
+
+    return headers
+
+
+################################################################################
+# build
+#
+# Run seq_hdf5_v2.py with the given arguments.
+################################################################################
+def build(monkeypatch, *args):
+    monkeypatch.setattr(sys, 'argv', ['seq_hdf5_v2.py'] + [str(arg) for arg in args])
+    seq_hdf5_v2.main()
+
+
+################################################################################
+# read_h5
+#
+# All datasets of an HDF5 file, as a dict of arrays.
+################################################################################
+def read_h5(h5_file):
+    with h5py.File(h5_file, 'r') as h5f:
+        return dict((name, h5f[name][()]) for name in h5f)
+
+
+################################################################################
+# assert_same_h5
+#
+# Check two HDF5 files hold the same datasets with equal values.
+################################################################################
+def assert_same_h5(h5_file, ref_file):
+    data = read_h5(h5_file)
+    ref = read_h5(ref_file)
+    assert sorted(data) == sorted(ref)
+    for name in ref:
+        assert data[name].dtype == ref[name].dtype, name
+        np.testing.assert_array_equal(data[name], ref[name], err_msg=name)
+
+
+################################################################################
+# data
+#
+# Fixture of the synthetic FASTA and scores files, two records unscored.
+################################################################################
+@pytest.fixture
+def data(tmp_path):
+    fasta_file = tmp_path / 'seqs.fa.gz'
+    scores_file = tmp_path / 'scores.txt.gz'
+    headers = write_data(fasta_file, scores_file, skip=('r3_s1','r17_s4'))
+    return fasta_file, scores_file, headers
+
+
+################################################################################
+# test_stream_matches_memory
+#
+# --stream writes the same file as the in-memory path, also encoding in
+# parallel, and from the --cache both when it misses and when it hits.
+################################################################################
+@pytest.mark.parametrize('args', [[], ['-r'], ['-b', '16'], ['-t', '0', '--vt'], ['-e', '50', '-a'], ['--workers', '3'], ['--block', '7', '--workers', '3'], ['--block', '7', '--workers', '3', '--codes', '-r'], ['--cache'], ['--cache', '-r']])
+def test_stream_matches_memory(tmp_path, monkeypatch, data, args):
+    fasta_file, scores_file, headers = data
+    if '-a' in args:
+        add_file = tmp_path / 'add.txt'
+        with open(add_file, 'w') as add_out:
+            print('id\tf1\tf2', file=add_out)
+            for hi, header in enumerate(headers):
+                if header not in ('r3_s1','r17_s4'):
+                    print('%s\t%d\t%.1f' % (header, hi, hi/2.0), file=add_out)
+        args = args[:-1] + ['-a', add_file]
+
+    # the in-memory path has no --cache or --codes
+    memory_args = [arg for arg in args if arg not in ('--cache','--codes')]
+    if '--cache' in args:
+        ci = args.index('--cache')
+        args = args[:ci+1] + [tmp_path / 'cache'] + args[ci+1:]
+        stream_runs = 2
+    else:
+        stream_runs = 1
+
+    split_args = ['-v', '0.1'] + ([] if '-t' in args else ['-t', '0.2'])
+    build(monkeypatch, *(split_args + memory_args + [fasta_file, scores_file, tmp_path / 'memory.h5']))
+    for ri in range(stream_runs):
+        build(monkeypatch, *(split_args + args + ['--stream', fasta_file, scores_file, tmp_path / 'stream.h5']))
+        if '--codes' in args:
+            assert_same_seqs(tmp_path / 'stream.h5', tmp_path / 'memory.h5')
+        else:
+            assert_same_h5(tmp_path / 'stream.h5', tmp_path / 'memory.h5')
+        if '--cache' in args:
+            assert list((tmp_path / 'cache').glob('*/codes_*.npy'))
+
+
+################################################################################
+# assert_same_seqs
+#
+# Check a file in another sequence layout decodes, through dna_io.read_seqs,
+# to the one hot sequences of a dense file, with the same other datasets.
+################################################################################
+def assert_same_seqs(h5_file, ref_file):
+    with h5py.File(h5_file, 'r') as h5f, h5py.File(ref_file, 'r') as ref_h5f:
+        for prefix in ['train','valid','test']:
+            if '%s_in' % prefix not in ref_h5f:
+                continue
+            ref_in = ref_h5f['%s_in' % prefix][()]
+            assert dna_io.num_seqs(h5f, prefix) == len(ref_in)
+            np.testing.assert_array_equal(dna_io.read_seqs(h5f, prefix, 0, len(ref_in)), ref_in, err_msg=prefix)
+
+            # decoded in blocks into a preallocated array
+            seqs = np.zeros_like(ref_in)
+            for r0 in range(0, len(ref_in), 7):
+                r1 = min(r0+7, len(ref_in))
+                dna_io.read_seqs(h5f, prefix, r0, r1, out=seqs[r0:r1])
+            np.testing.assert_array_equal(seqs, ref_in, err_msg=prefix)
+
+        for name in ref_h5f:
+            if not name.endswith('_in'):
+                np.testing.assert_array_equal(h5f[name][()], ref_h5f[name][()], err_msg=name)
+
+
+################################################################################
+# test_codes_decode
+################################################################################
+@pytest.mark.parametrize('args', [[], ['-r']])
+def test_codes_decode(tmp_path, monkeypatch, data, args):
+    fasta_file, scores_file, headers = data
+    build(monkeypatch, *(['--stream', '-v', '0.1', '-t', '0.2'] + args + [fasta_file, scores_file, tmp_path / 'dense.h5']))
+    build(monkeypatch, *(['--stream', '--codes', '-v', '0.1', '-t', '0.2'] + args + [fasta_file, scores_file, tmp_path / 'codes.h5']))
+
+    with h5py.File(tmp_path / 'codes.h5', 'r') as h5f:
+        assert h5f['train_in'].dtype == np.uint8
+    assert_same_seqs(tmp_path / 'codes.h5', tmp_path / 'dense.h5')
+
+
+################################################################################
+# test_sparse_decode
+#
+# Samples of a region share its window, in blocks that split regions.
+################################################################################
+@pytest.mark.parametrize('args', [[], ['-r'], ['--hash_split']])
+def test_sparse_decode(tmp_path, monkeypatch, data, args):
+    fasta_file, scores_file, headers = data
+    build(monkeypatch, *(['--stream', '-v', '0.1', '-t', '0.2'] + args + [fasta_file, scores_file, tmp_path / 'dense.h5']))
+    build(monkeypatch, *(['--sparse', '--block', '5', '-v', '0.1', '-t', '0.2'] + args + [fasta_file, scores_file, tmp_path / 'sparse.h5']))
+
+    with h5py.File(tmp_path / 'sparse.h5', 'r') as h5f:
+        assert h5f['windows'].shape[0] == len(set(header.split('_')[0] for header in headers))
+    assert_same_seqs(tmp_path / 'sparse.h5', tmp_path / 'dense.h5')
+
+
+################################################################################
+# test_dedup_decode
+#
+# Repeated sequences are stored once in seqs_unique; sequences differing
+# only in case are distinct records but encode alike.
+################################################################################
+@pytest.mark.parametrize('args', [[], ['-r'], ['--codes', '-r']])
+def test_dedup_decode(tmp_path, monkeypatch, data, args):
+    fasta_file, scores_file, headers = data
+    dense_args = [arg for arg in args if arg != '--codes']
+    build(monkeypatch, *(['--stream', '-v', '0.1', '-t', '0.2'] + dense_args + [fasta_file, scores_file, tmp_path / 'dense.h5']))
+    build(monkeypatch, *(['--dedup', '--block', '16', '-v', '0.1', '-t', '0.2'] + args + [fasta_file, scores_file, tmp_path / 'dedup.h5']))
+
+    dense = read_h5(tmp_path / 'dense.h5')
+    dense_in = np.concatenate([dense['%s_in' % prefix] for prefix in ['train','valid','test']])
+    with h5py.File(tmp_path / 'dedup.h5', 'r') as h5f:
+        assert len(np.unique(dense_in, axis=0)) <= h5f['seqs_unique'].shape[0] < len(dense_in)
+    assert_same_seqs(tmp_path / 'dedup.h5', tmp_path / 'dense.h5')
+
+
+################################################################################
+# test_validate
+#
+# validate_hdf5 matches rows to FASTA records whatever their order, layout
+# or dropped records.
+################################################################################
+@pytest.mark.parametrize('args', [[], ['-r'], ['-t', '0', '--vt'], ['--stream', '-r'], ['--hash_split'], ['--codes', '--stream', '-r'], ['--sparse', '-r'], ['--dedup', '-r']])
+def test_validate(tmp_path, monkeypatch, data, args):
+    fasta_file, scores_file, headers = data
+    split_args = ['-v', '0.1'] + ([] if '-t' in args else ['-t', '0.2'])
+    build(monkeypatch, *(split_args + args + [fasta_file, scores_file, tmp_path / 'seqs.h5']))
+
+    with h5py.File(tmp_path / 'seqs.h5', 'r') as h5f:
+        num_rows = sum(dna_io.num_seqs(h5f, prefix) for prefix in ['train','valid','test'] if '%s_out' % prefix in h5f)
+    assert dna_io.validate_hdf5(str(tmp_path / 'seqs.h5'), str(fasta_file), str(tmp_path / 'report.txt'), block_size=16) == (num_rows, 0)
+
+
+################################################################################
+# test_validate_mismatch
+#
+# A changed row is reported under its own header, and files without
+# *_records are refused.
+################################################################################
+def test_validate_mismatch(tmp_path, monkeypatch, data):
+    fasta_file, scores_file, headers = data
+    build(monkeypatch, '-r', '-v', '0.1', '-t', '0.2', fasta_file, scores_file, tmp_path / 'seqs.h5')
+
+    fasta_headers = [header for header, seq in dna_io.read_fasta(str(fasta_file))]
+    with h5py.File(tmp_path / 'seqs.h5', 'r+') as h5f:
+        changed = fasta_headers[h5f['valid_records'][3]].decode('ascii')
+        h5f['valid_in'][3] = dna_io.encode_batch(['T'*40], 40)[0]
+
+    report_file = tmp_path / 'report.txt'
+    num_checked, num_mismatched = dna_io.validate_hdf5(str(tmp_path / 'seqs.h5'), str(fasta_file), str(report_file))
+    assert num_mismatched == 1
+    report = [line.split('\t') for line in open(report_file).read().splitlines()[1:]]
+    assert [line[:3] for line in report] == [['valid', '3', changed]]
+
+    with h5py.File(tmp_path / 'seqs.h5', 'r+') as h5f:
+        del h5f['train_records']
+    with pytest.raises(ValueError, match='train_records'):
+        dna_io.validate_hdf5(str(tmp_path / 'seqs.h5'), str(fasta_file))
+
+
+################################################################################
+# split_fasta
+#
+# Write the records of a FASTA file before and from the first record of
+# region first_region to two FASTA files.
+################################################################################
+def split_fasta(fasta_file, first_region, fasta1_file, fasta2_file):
+    with open(fasta1_file, 'wb') as fasta1_out, open(fasta2_file, 'wb') as fasta2_out:
+        fasta_out = fasta1_out
+        for header, seq in dna_io.read_fasta(str(fasta_file)):
+            if header == b'r%d_s0' % first_region:
+                fasta_out = fasta2_out
+            fasta_out.write(b'>' + header + b'\n' + bytes(seq) + b'\n')
+
+
+################################################################################
+# test_append_matches_build
+#
+# A --hash_split build of half the records, grown by --append with the rest,
+# equals one build of all records; the second half scores only some of the
+# labels.
+################################################################################
+@pytest.mark.parametrize('args', [[], ['--codes'], ['--sparse'], ['--dedup']])
+def test_append_matches_build(tmp_path, monkeypatch, data, args):
+    fasta_file, scores_file, headers = data
+    split_fasta(fasta_file, 20, tmp_path / 'seqs1.fa', tmp_path / 'seqs2.fa')
+
+    # no label c among the appended records
+    sub_scores_file = tmp_path / 'sub_scores.txt.gz'
+    with gzip.open(scores_file, 'rt') as scores_in, gzip.open(sub_scores_file, 'wt') as scores_out:
+        for line in scores_in:
+            header, label = line.split('\t')[:2]
+            if not (label == 'c' and header.startswith('r') and int(header[1:].split('_')[0]) >= 20):
+                scores_out.write(line)
+
+    split_args = ['--hash_split', '-v', '0.2', '-t', '0.2', '-e', '40', '--block', '16'] + args
+    build(monkeypatch, *(split_args + [fasta_file, sub_scores_file, tmp_path / 'all.h5']))
+    build(monkeypatch, *(split_args + [tmp_path / 'seqs1.fa', sub_scores_file, tmp_path / 'grown.h5']))
+    build(monkeypatch, *(split_args + ['--append', tmp_path / 'seqs2.fa', sub_scores_file, tmp_path / 'grown.h5']))
+
+    if '--dedup' in args or '--sparse' in args:
+        # distinct sequences and windows are chosen per run, so compare
+        # the decoded sequences
+        build(monkeypatch, *(['--hash_split', '-v', '0.2', '-t', '0.2', '-e', '40', fasta_file, sub_scores_file, tmp_path / 'dense.h5']))
+        assert_same_seqs(tmp_path / 'grown.h5', tmp_path / 'dense.h5')
+    else:
+        assert_same_h5(tmp_path / 'grown.h5', tmp_path / 'all.h5')
+    assert dna_io.validate_hdf5(str(tmp_path / 'grown.h5'), str(fasta_file))[1] == 0
+
+    # labels the file lacks are refused
+    with gzip.open(tmp_path / 'new_scores.txt.gz', 'wt') as scores_out:
+        print('id\tlabel\tscore\nr25_s0\tz\t1', file=scores_out)
+    with pytest.raises(ValueError, match='not in target_labels'):
+        build(monkeypatch, *(split_args + ['--append', tmp_path / 'seqs2.fa', tmp_path / 'new_scores.txt.gz', tmp_path / 'grown.h5']))
+
+
+################################################################################
+# test_append_without_annot
+#
+# Files written before *_annot existed are appended to without them.
+################################################################################
+def test_append_without_annot(tmp_path, monkeypatch, data):
+    fasta_file, scores_file, headers = data
+    split_fasta(fasta_file, 20, tmp_path / 'seqs1.fa', tmp_path / 'seqs2.fa')
+
+    build(monkeypatch, '--stream', '-e', '40', tmp_path / 'seqs1.fa', scores_file, tmp_path / 'grown.h5')
+    with h5py.File(tmp_path / 'grown.h5', 'r+') as h5f:
+        del h5f['train_annot']
+    build(monkeypatch, '--append', '-e', '40', tmp_path / 'seqs2.fa', scores_file, tmp_path / 'grown.h5')
+
+    with h5py.File(tmp_path / 'grown.h5', 'r') as h5f:
+        assert 'train_annot' not in h5f
+        assert h5f['train_in'].shape[0] == h5f['train_out'].shape[0] == len(headers) - 2
+
+
+################################################################################
+# test_append_rejected
+#
+# An --append rejected by check_append leaves the file as it was, datasets
+# and attributes alike.
+################################################################################
+@pytest.mark.parametrize('args, shorten', [(['--pivot'], None), ([], 'train_records'), ([], 'train_annot')])
+def test_append_rejected(tmp_path, monkeypatch, data, args, shorten):
+    fasta_file, scores_file, headers = data
+    split_fasta(fasta_file, 20, tmp_path / 'seqs1.fa', tmp_path / 'seqs2.fa')
+
+    build(monkeypatch, '--stream', '-e', '40', tmp_path / 'seqs1.fa', scores_file, tmp_path / 'grown.h5')
+    if shorten is not None:
+        with h5py.File(tmp_path / 'grown.h5', 'r+') as h5f:
+            h5f[shorten].resize((h5f[shorten].shape[0]-1,))
+    before = read_h5(tmp_path / 'grown.h5')
+    with h5py.File(tmp_path / 'grown.h5', 'r') as h5f:
+        attrs_before = dict(h5f.attrs)
+
+    with pytest.raises(ValueError):
+        build(monkeypatch, *(['--append', '-e', '40'] + args + [tmp_path / 'seqs2.fa', scores_file, tmp_path / 'grown.h5']))
+
+    after = read_h5(tmp_path / 'grown.h5')
+    assert sorted(after) == sorted(before)
+    for name in before:
+        np.testing.assert_array_equal(after[name], before[name])
+    with h5py.File(tmp_path / 'grown.h5', 'r') as h5f:
+        assert dict(h5f.attrs) == attrs_before
+
+
+################################################################################
+# test_pivot_matches_pandas
+#
+# --pivot, streamed or not and dense or CSR, gives the pandas pivot of the
+# score lines, the last of repeated (header, label) lines winning; without
+# --pivot, headers with several labels are an error.
+################################################################################
+@pytest.mark.parametrize('args', [[], ['-r'], ['--stream', '-r'], ['--pivot_csr', '-r']])
+def test_pivot_matches_pandas(tmp_path, monkeypatch, data, args):
+    import pandas as pd
+    fasta_file, scores_file, headers = data
+
+    rng = np.random.RandomState(2)
+    multi_file = tmp_path / 'multi.txt.gz'
+    with gzip.open(multi_file, 'wt') as scores_out:
+        print('id\tlabel\tscore', file=scores_out)
+        for header in headers[::-1] + ['missing']:
+            for label in rng.choice(['x','y','z','w'], size=rng.randint(1, 5)):
+                print('%s\t%s\t%.2f' % (header, label, rng.random_sample()), file=scores_out)
+
+    build(monkeypatch, *(['--pivot', '--pivot_fill', 'nan', '-v', '0.1', '-t', '0.2'] + args + [fasta_file, multi_file, tmp_path / 'pivot.h5']))
+
+    scores = pd.read_csv(multi_file, sep='\t')
+    scores = scores.drop_duplicates(['id','label'], keep='last').pivot(index='id', columns='label', values='score')
+
+    fasta_headers = np.array([header for header, seq in dna_io.read_fasta(str(fasta_file))]).astype(str)
+    with h5py.File(tmp_path / 'pivot.h5', 'r') as h5f:
+        assert list(h5f['target_labels'][()].astype(str)) == list(scores.columns)
+        for prefix in ['train','valid','test']:
+            split_headers = fasta_headers[h5f['%s_records' % prefix][()]]
+            targets = dna_io.read_targets(h5f, prefix, 0, len(split_headers))
+            np.testing.assert_allclose(targets, scores.loc[split_headers].values, rtol=1e-6, err_msg=prefix)
+
+    with pytest.raises(ValueError, match='several labels'):
+        build(monkeypatch, *([arg for arg in args if arg != '--pivot_csr'] + [fasta_file, multi_file, tmp_path / 'single.h5']))
+
+
+################################################################################
+# test_read_scores_dtype
+#
+# Integer scores are stored as int8 only if they fit, e.g. counts stay exact.
+################################################################################
+@pytest.mark.parametrize('values,dtype', [(['-5','3','127'], np.int8), (['1','200'], np.float64), (['-129','0'], np.float64), (['0.5','1'], np.float64)])
+def test_read_scores_dtype(tmp_path, values, dtype):
+    scores_file = tmp_path / 'scores.txt.gz'
+    with gzip.open(scores_file, 'wt') as scores_out:
+        print('id\tlabel\tscore', file=scores_out)
+        for vi, value in enumerate(values):
+            print('s%d\ta\t%s' % (vi, value), file=scores_out)
+
+    scores = dna_io.read_scores(str(scores_file))[3]
+    assert scores.dtype == dtype
+    np.testing.assert_array_equal(scores, np.array(values, dtype='float64'))
+
+
+################################################################################
+# test_check_order
+#
+# FASTA records beyond the rows, e.g. unscored ones dropped by
+# load_data_1hot, fail check_order instead of crashing it.
+################################################################################
+def test_check_order(tmp_path, data, capsys):
+    fasta_file, scores_file, headers = data
+    seqs = dna_io.load_data_1hot(str(fasta_file), str(scores_file), mean_norm=False, permute=False)[0]
+    assert len(seqs) == len(headers) - 2
+
+    assert not dna_io.check_order(seqs, str(fasta_file))
+    assert '2 records beyond the %d rows' % len(seqs) in capsys.readouterr().out
+
+    # without the unscored records, all rows match
+    kept_file = tmp_path / 'kept.fa'
+    with open(kept_file, 'wb') as fasta_out:
+        for header, seq in dna_io.read_fasta(str(fasta_file)):
+            if seq and header not in (b'r3_s1', b'r17_s4'):
+                fasta_out.write(b'>' + header + b'\n' + bytes(seq) + b'\n')
+    assert dna_io.check_order(seqs, str(kept_file))
+
+
+################################################################################
+# test_validate_in_order
+#
+# Files whose rows follow FASTA order are checked in one pass, without
+# spilling the FASTA.
+################################################################################
+@pytest.mark.parametrize('args', [[], ['--stream', '--sparse']])
+def test_validate_in_order(tmp_path, monkeypatch, data, args):
+    fasta_file, scores_file, headers = data
+    build(monkeypatch, *(['-v', '0.1', '-t', '0.2'] + args + [fasta_file, scores_file, tmp_path / 'seqs.h5']))
+
+    def no_spill(records, order):
+        raise AssertionError('FASTA spilled')
+    monkeypatch.setattr(dna_io, 'permute_records', no_spill)
+    assert dna_io.validate_hdf5(str(tmp_path / 'seqs.h5'), str(fasta_file), block_size=16) == (len(headers) - 2, 0)
+
+    # a FASTA missing its last records reports the rows left over
+    short_file = tmp_path / 'short.fa'
+    with open(short_file, 'wb') as fasta_out:
+        for header, seq in itertools.islice(dna_io.read_fasta(str(fasta_file)), 200):
+            fasta_out.write(b'>' + header + b'\n' + bytes(seq) + b'\n')
+    num_checked, num_mismatched = dna_io.validate_hdf5(str(tmp_path / 'seqs.h5'), str(short_file), block_size=16)
+    assert num_mismatched >= len(headers) - 2 - num_checked > 0